@@ -0,0 +1,249 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+import numpy as np
+from manim import Create, tempconfig
+
+import main
+
+RESULTS_FILE = os.path.join("media", "bench", "results.jsonl")
+
+# n vertices, m edges, flips matching changes, steps rearrange() calls
+Case = namedtuple("Case", ["graph", "n", "m", "flips", "steps"])
+
+CASES = {
+    "small": Case("Graph", 20, 40, 10, 3),
+    "medium": Case("Graph", 200, 600, 50, 3),
+    "medium-batched": Case("BatchedGraph", 200, 600, 50, 3),
+    "large-batched": Case("BatchedGraph", 5000, 15000, 500, 3),
+}
+# cases that are also rendered end to end, at -ql
+RENDER_CASES = ["small", "medium", "medium-batched"]
+
+
+# A random graph with vertices spread over most of the frame, built the way
+# the loaders build them. Everything is drawn from one seed, so a case is
+# the same graph with the same flips on every run.
+def random_graph(case, seed=0):
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform([-6, -3.5], [6, 3.5], (case.n, 2))
+    graph = getattr(main, case.graph)(
+        {i: [x, y, 0] for (i, (x, y)) in enumerate(positions.tolist())}, scale=0.3
+    )
+    pairs = set()
+    while len(pairs) < min(case.m, case.n * (case.n - 1) // 2):
+        u, v = sorted(rng.integers(case.n, size=2).tolist())
+        if u != v:
+            pairs.add((u, v))
+    u, v = np.array(sorted(pairs)).T
+    graph.add_edge_ids(u, v)
+    graph.make_edges()
+    return graph, rng
+
+
+# Matches a random edge whose ends are both free, or unmatches a random
+# matched edge one time in four (when there is one).
+def flip(graph, rng):
+    u, v = graph.get_edge_ids()
+    if graph.matching and rng.random() < 0.25:
+        edges = sorted(graph.matching)
+        graph.unmatch(*edges[rng.integers(len(edges))])
+        return
+    for i in rng.permutation(len(u))[:100]:
+        if graph.mate[u[i]] == -1 and graph.mate[v[i]] == -1:
+            graph.match(graph.labels[u[i]], graph.labels[v[i]])
+            return
+
+
+def random_walk(graph, rng, length):
+    path = [graph.labels[rng.integers(len(graph.labels))]]
+    while len(path) < length:
+        neighbors = list(graph.neighbors(path[-1]))
+        if not neighbors:
+            break
+        path.append(neighbors[rng.integers(len(neighbors))])
+    return path
+
+
+def new_positions(graph, rng):
+    positions = rng.uniform([-6, -3.5], [6, 3.5], (len(graph.labels), 2)).tolist()
+    return {label: [x, y, 0] for (label, (x, y)) in zip(graph.labels, positions)}
+
+
+# Steps an animation through a second's worth of frames at -ql, without
+# drawing them.
+def run_frames(animation, frames=15):
+    animation.begin()
+    for alpha in np.linspace(0, 1, frames):
+        animation.interpolate(alpha)
+    animation.finish()
+
+
+def best_of(repeat, setup, body):
+    best = float("inf")
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        body(*state)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+# Seconds per operation, best of `repeat` runs, each on a freshly built graph.
+def time_operations(case, repeat):
+    def fresh():
+        return random_graph(case)
+
+    def flipped():
+        graph, rng = random_graph(case)
+        for _ in range(case.flips):
+            flip(graph, rng)
+        return graph, rng
+
+    def update_matching(graph, rng):
+        for animation in graph.update_matching():
+            run_frames(animation)
+
+    def rearrange(graph, rng):
+        for _ in range(case.steps):
+            run_frames(graph.rearrange(new_positions(graph, rng)))
+
+    def highlight_path(graph, rng):
+        for _ in range(100):
+            graph.highlight_path(*random_walk(graph, rng, 20))
+
+    start = time.perf_counter()
+    fresh()
+    return {
+        "build": time.perf_counter() - start,
+        "update_matching": best_of(repeat, flipped, update_matching),
+        "rearrange": best_of(repeat, fresh, rearrange),
+        "highlight_path": best_of(repeat, fresh, highlight_path),
+    }
+
+
+# The same operations as a scene: draw the graph, play the flips in ten
+# rounds of update_matching, then the rearranges and a highlighted path.
+class GraphBenchScene(main.MyScene):
+    case = CASES["small"]
+
+    def setup(self):
+        # nothing to precompile, and the class is made by type() so
+        # precompile_tex could not read its source anyway
+        pass
+
+    def construct(self):
+        graph, rng = random_graph(self.case)
+        self.add(graph.get_group())
+        for _ in range(10):
+            for _ in range(max(1, self.case.flips // 10)):
+                flip(graph, rng)
+            animations = graph.update_matching()
+            if animations:
+                self.play(*animations)
+        for _ in range(self.case.steps):
+            self.play(graph.rearrange(new_positions(graph, rng)))
+        self.play(Create(graph.highlight_path(*random_walk(graph, rng, 20))))
+
+
+def time_render(name):
+    class_name = "Bench" + name.title().replace("-", "")
+    scene = type(class_name, (GraphBenchScene,), {"case": CASES[name]})
+    with tempfile.TemporaryDirectory() as media_dir:
+        options = {
+            "quality": "low_quality",
+            "media_dir": media_dir,
+            "disable_caching": True,
+            "verbosity": "ERROR",
+            "progress_bar": "none",
+        }
+        with tempconfig(options):
+            start = time.perf_counter()
+            scene().render()
+            return time.perf_counter() - start
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"]).returncode != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ("+" if dirty else "")
+
+
+def load_results():
+    if not os.path.exists(RESULTS_FILE):
+        return []
+    with open(RESULTS_FILE) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# One line per case and timing: this run's seconds and, when the results
+# file has an earlier run of the same case, the change against it.
+def report(result, previous):
+    before = {}
+    for entry in previous:
+        for case, timings in entry["timings"].items():
+            if entry["cases"].get(case) == result["cases"].get(case):
+                before.setdefault(case, {}).update(
+                    (key, (entry["revision"], value))
+                    for (key, value) in timings.items()
+                )
+    for case, timings in result["timings"].items():
+        for key, seconds in timings.items():
+            line = f"{case:16} {key:16} {seconds:9.4f}s"
+            if key in before.get(case, {}):
+                revision, old = before[case][key]
+                line += f"  {100 * (seconds - old) / old:+7.1f}% vs {revision}"
+            print(line)
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(
+        description="Time Graph operations and renders, and record the results."
+    )
+    parser.add_argument("cases", nargs="*", help="case names (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per timing")
+    parser.add_argument(
+        "--no-render", action="store_true", help="skip the full -ql renders"
+    )
+    parser.add_argument(
+        "--dry", action="store_true", help=f"do not append to {RESULTS_FILE}"
+    )
+    args = parser.parse_args(argv)
+    names = args.cases or list(CASES)
+
+    timings = {}
+    for name in names:
+        timings[name] = time_operations(CASES[name], args.repeat)
+        if name in RENDER_CASES and not args.no_render:
+            timings[name]["render"] = time_render(name)
+
+    result = {
+        "revision": git_revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "cases": {name: CASES[name]._asdict() for name in names},
+        "timings": timings,
+    }
+    report(result, load_results())
+    if not args.dry:
+        os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+        with open(RESULTS_FILE, "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
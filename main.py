@@ -3,9 +3,275 @@ from manim.animation.animation import DEFAULT_ANIMATION_RUN_TIME
 from manim.mobject.opengl_compatibility import ConvertToOpenGL
 
 # from manim_presentation import Slide #as MyScene
+from array import array
+from collections import deque, namedtuple
+from collections.abc import Set as AbstractSet
+import heapq
+from bisect import bisect_left
 from typing import Callable, Iterable, Optional, Sequence
 from math import sin, cos, pi, sqrt
 import numpy as np
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import ast
+import gzip
+import xml.etree.ElementTree as ElementTree
+import inspect
+import re
+import subprocess
+import csv
+import json
+import time
+import queue
+import threading
+from PIL import Image
+from manim.mobject.svg import tex_mobject
+from manim.utils import tex_file_writing
+from manim.utils.family import extract_mobject_family_members
+
+# Compiled TeX shared by every scene, process and run: one SVG per unique
+# LaTeX source, so each string is compiled once for the whole deck.
+# font_size is not part of the key since manim only scales the SVG
+# afterwards. The store is bounded, evicting the least recently used SVGs
+# (by mtime), and guarded by flock so parallel renders wait for each
+# other instead of compiling the same string twice. Keys share a fixed set
+# of lock files, so the store does not gain a file for every expression.
+TEX_CACHE_DIR = os.path.abspath(os.path.join("media", "tex_cache"))
+TEX_CACHE_MAX_BYTES = 64 * 1024 * 1024
+TEX_LOCK_STRIPES = 64
+
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.file = open(self.path, "a")
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+def _tex_lock(name):
+    digest = hashlib.sha256(name.encode()).digest()
+    stripe = int.from_bytes(digest[:4], "big") % TEX_LOCK_STRIPES
+    return _FileLock(os.path.join(TEX_CACHE_DIR, f".lock-{stripe:02d}"))
+
+
+def _evict_tex_cache():
+    with _FileLock(os.path.join(TEX_CACHE_DIR, ".evict.lock")):
+        entries = []
+        for entry in os.scandir(TEX_CACHE_DIR):
+            if entry.name.endswith(".svg"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= TEX_CACHE_MAX_BYTES:
+                break
+            os.remove(path)
+            total -= size
+
+
+def _tex_key(expression, environment, tex_template):
+    if environment is not None:
+        source = tex_template.get_texcode_for_expression_in_env(expression, environment)
+    else:
+        source = tex_template.get_texcode_for_expression(expression)
+    key = [source, tex_template.tex_compiler, tex_template.output_format]
+    return hashlib.sha256("\0".join(key).encode()).hexdigest()
+
+
+def _copy_atomic(src, dst):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst), suffix=".tmp")
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def cached_tex_to_svg_file(expression, environment=None, tex_template=None):
+    if tex_template is None:
+        tex_template = config["tex_template"]
+    if _tex_recorder is not None:
+        _tex_recorder.append((expression, environment, tex_template))
+        return _placeholder_svg()
+    key = _tex_key(expression, environment, tex_template)
+    # manim reads the SVG from its own tex_dir, so eviction from the shared
+    # store can never pull a file out from under a scene being built
+    local = os.path.join(config.get_dir("tex_dir"), key + ".svg")
+    if os.path.exists(local):
+        return local
+    os.makedirs(TEX_CACHE_DIR, exist_ok=True)
+    os.makedirs(os.path.dirname(local), exist_ok=True)
+    shared = os.path.join(TEX_CACHE_DIR, key + ".svg")
+    with _tex_lock(key):
+        # eviction only takes its own lock, so hold it off while copying
+        try:
+            with _FileLock(os.path.join(TEX_CACHE_DIR, ".evict.lock")):
+                os.utime(shared)
+                _copy_atomic(shared, local)
+            return local
+        except FileNotFoundError:
+            pass
+        svg = _tex_to_svg_file(expression, environment, tex_template)
+        _copy_atomic(svg, shared)
+        _copy_atomic(svg, local)
+    _evict_tex_cache()
+    return local
+
+
+# Compiling a scene's TeX strings one at a time means one LaTeX and one
+# dvisvgm process each. Before construct() runs, the literal Tex/MathTex
+# calls in the scene's source are instantiated against a placeholder SVG,
+# which records the exact expressions manim would compile (joined and
+# per-substring alike). Those not in the store yet are compiled together,
+# one preview page each, and the pages are split back into the store.
+# Strings built at runtime are left to cached_tex_to_svg_file as before,
+# as is everything in a batch that fails to compile.
+_tex_recorder = None
+_TEX_SOURCE_KWARGS = {
+    "arg_separator",
+    "substrings_to_isolate",
+    "tex_environment",
+    "tex_template",
+    "tex_to_color_map",
+}
+_TEX_COMPILERS = {"latex", "pdflatex", "luatex", "lualatex", "xelatex"}
+
+
+def _placeholder_svg():
+    path = os.path.join(tempfile.gettempdir(), "manim_tex_placeholder.svg")
+    if not os.path.exists(path):
+        # written whole and renamed into place, since parallel renders may
+        # read it while another process is still writing it
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(
+                '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 1 1">'
+                '<path d="M0 0L1 0L1 1Z"/></svg>'
+            )
+        os.replace(tmp, path)
+    return path
+
+
+def _literal_tex_calls(scene_class):
+    tree = ast.parse(inspect.getsource(scene_class).lstrip())
+    for node in ast.walk(tree):
+        if not (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id in ("Tex", "MathTex")
+        ):
+            continue
+        try:
+            args = [ast.literal_eval(arg) for arg in node.args]
+            kwargs = {}
+            for kw in node.keywords:
+                if kw.arg is None:
+                    kwargs.update(ast.literal_eval(kw.value))
+                # font_size, color and the like only style the compiled SVG
+                elif kw.arg in _TEX_SOURCE_KWARGS:
+                    kwargs[kw.arg] = ast.literal_eval(kw.value)
+        except (ValueError, TypeError):
+            continue
+        yield globals()[node.func.id], args, kwargs
+
+
+def _batch_compile(compiler, output_format, preamble, jobs, workdir):
+    if compiler not in _TEX_COMPILERS:
+        return
+    pages = []
+    for _, (expression, environment, tex_template) in jobs:
+        if environment is not None:
+            source = tex_template.get_texcode_for_expression_in_env(
+                expression, environment
+            )
+        else:
+            source = tex_template.get_texcode_for_expression(expression)
+        body = source.partition("\\begin{document}")[2]
+        pages.append(body.rpartition("\\end{document}")[0])
+    # one tight page per expression, as standalone's preview option does
+    preamble = re.sub(
+        r"\\documentclass(\[[^\]]*\])?\{standalone\}",
+        r"\\documentclass{article}",
+        preamble,
+        count=1,
+    )
+    with open(os.path.join(workdir, "batch.tex"), "w") as f:
+        f.write(preamble)
+        f.write("\\usepackage[active,tightpage]{preview}\n\\begin{document}\n")
+        for page in pages:
+            f.write("\\begin{preview}\n" + page + "\n\\end{preview}\n")
+        f.write("\\end{document}\n")
+    command = [compiler, "-interaction=batchmode", "-halt-on-error"]
+    if compiler == "xelatex":
+        if output_format == ".xdv":
+            command.append("-no-pdf")
+    else:
+        command.append(f"-output-format={output_format[1:]}")
+    subprocess.run(
+        command + ["batch.tex"], cwd=workdir, check=True, stdout=subprocess.DEVNULL
+    )
+    command = ["dvisvgm", "batch" + output_format, "-p", "1-", "-n", "-v", "0"]
+    if output_format == ".pdf":
+        command.append("--pdf")
+    subprocess.run(command + ["-o", "page-%6p.svg"], cwd=workdir, check=True)
+    svgs = sorted(name for name in os.listdir(workdir) if name.startswith("page-"))
+    # a page per expression, or the split would hand out the wrong SVGs
+    if len(svgs) != len(jobs):
+        return
+    svgs = [os.path.join(workdir, svg) for svg in svgs]
+    for (key, _), svg in zip(jobs, svgs):
+        _copy_atomic(svg, os.path.join(TEX_CACHE_DIR, key + ".svg"))
+
+
+def precompile_tex(scene_class):
+    global _tex_recorder
+    _tex_recorder = recorded = []
+    try:
+        for cls, args, kwargs in _literal_tex_calls(scene_class):
+            try:
+                cls(*args, **kwargs)
+            except Exception:
+                pass
+    finally:
+        _tex_recorder = None
+    os.makedirs(TEX_CACHE_DIR, exist_ok=True)
+    # segments of the same scene rendered in parallel wait for one batch
+    with _tex_lock(scene_class.__name__):
+        groups = {}
+        for expression, environment, tex_template in recorded:
+            key = _tex_key(expression, environment, tex_template)
+            if os.path.exists(os.path.join(TEX_CACHE_DIR, key + ".svg")):
+                continue
+            # expressions sharing a preamble can share a document
+            source = tex_template.get_texcode_for_expression("")
+            preamble = source.partition("\\begin{document}")[0]
+            group = (tex_template.tex_compiler, tex_template.output_format, preamble)
+            groups.setdefault(group, {})[key] = (expression, environment, tex_template)
+        for group, jobs in groups.items():
+            with tempfile.TemporaryDirectory() as workdir:
+                try:
+                    _batch_compile(*group, list(jobs.items()), workdir)
+                except (OSError, subprocess.CalledProcessError):
+                    pass
+    if groups:
+        _evict_tex_cache()
+
+
+_tex_to_svg_file = tex_file_writing.tex_to_svg_file
+tex_file_writing.tex_to_svg_file = cached_tex_to_svg_file
+tex_mobject.tex_to_svg_file = cached_tex_to_svg_file
 
 
 # class MyScene(Slide):
@@ -13,12 +279,526 @@ import numpy as np
 #         super(MyScene, self).__init__(*args, **kwargs)
 
 
+# Per-call profile of a scene, switched on by setting PROFILE_DIR (render.py
+# --profile does). Every play() and wait(), and so every pause(), gets the
+# wall time manim spent in each stage, found by timing the scene, renderer
+# and file writer methods that make up a play: compiling and beginning the
+# animations, interpolating the mobjects, drawing the frames, and writing
+# them out. Nested stages only count once, against the innermost one.
+# With frames piped from a thread (see _FrameQueue), encode is copying
+# each frame into the ring, queue is the time spent waiting for the
+# thread to free a slot or finish a movie, and pipe is how long the thread
+# spent writing the call's frames to ffmpeg, alongside the other stages
+# rather than as part of the total.
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+PROFILE_STAGES = ("setup", "interpolate", "render", "encode", "queue")
+
+
+class _PlayProfiler:
+    def __init__(self, scene):
+        self.scene = scene
+        self.records = []
+        self.current = None
+        self.nested = []
+        file_writer = scene.renderer.file_writer
+        self._wrap(scene, "compile_animation_data", "setup")
+        self._wrap(scene, "begin_animations", "setup")
+        self._wrap(scene, "update_to_time", "interpolate")
+        self._wrap(scene.renderer, "update_frame", "render")
+        self._wrap(file_writer, "write_frame", "encode")
+        self._wrap(file_writer, "end_animation", "encode")
+        self.frame_queue = getattr(scene, "frame_queue", None)
+        if self.frame_queue is not None:
+            self._wrap(self.frame_queue, "_next_slot", "queue")
+            self._wrap(self.frame_queue, "_drain", "queue")
+
+    def _wrap(self, owner, name, stage):
+        method = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            if self.current is None:
+                return method(*args, **kwargs)
+            if name == "write_frame":
+                self.current["frames"] += 1
+            self.nested.append(0.0)
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.current[stage] += elapsed - self.nested.pop()
+                if self.nested:
+                    self.nested[-1] += elapsed
+
+        setattr(owner, name, timed)
+
+    # The line in this file that the call came from, and whether it was a
+    # play, a wait or a pause.
+    @staticmethod
+    def _call_site(frame):
+        kind = "play"
+        while frame is not None:
+            name = frame.f_code.co_name
+            if name in ("play", "wait", "pause") and isinstance(
+                frame.f_locals.get("self"), Scene
+            ):
+                kind = kind if name == "play" else name
+            elif frame.f_code.co_filename == __file__:
+                return kind, frame.f_lineno
+            frame = frame.f_back
+        return kind, None
+
+    def play(self, play, args, kwargs):
+        scene = self.scene
+        kind, line = self._call_site(inspect.currentframe().f_back)
+        self.current = dict.fromkeys(PROFILE_STAGES, 0.0)
+        self.current.update(
+            index=scene.renderer.num_plays,
+            kind=kind,
+            line=line,
+            animations=" ".join(type(arg).__name__ for arg in args),
+            frames=0,
+        )
+        pipe = 0.0 if self.frame_queue is None else self.frame_queue.pipe_seconds
+        start = time.perf_counter()
+        try:
+            return play(*args, **kwargs)
+        finally:
+            record = self.current
+            self.current = None
+            record["total"] = time.perf_counter() - start
+            record["other"] = record["total"] - sum(map(record.get, PROFILE_STAGES))
+            if self.frame_queue is not None:
+                pipe = self.frame_queue.pipe_seconds - pipe
+            record["pipe"] = pipe
+            # cached or outside the -n range: the frames were never drawn
+            record["rendered"] = not scene.renderer.skip_animations
+            record["mobjects"] = len(scene.mobjects)
+            record["family"] = len(scene.get_mobject_family_members())
+            self.records.append(record)
+
+    # Writes <scene>.json (every call plus the lines costing the most time)
+    # and <scene>.csv (every call); a scene rendered in segments writes one
+    # pair per segment, named after the first animation in it.
+    def write(self, directory):
+        name = type(self.scene).__name__
+        if config.from_animation_number:
+            name += f"-{config.from_animation_number}"
+        os.makedirs(directory, exist_ok=True)
+        by_line = {}
+        for record in self.records:
+            if record["rendered"]:
+                entry = by_line.setdefault(record["line"], {"calls": 0, "total": 0.0})
+                entry["calls"] += 1
+                entry["total"] += record["total"]
+        slowest = [
+            dict(line=line, **entry)
+            for (line, entry) in sorted(by_line.items(), key=lambda x: -x[1]["total"])
+        ]
+        report = {
+            "scene": type(self.scene).__name__,
+            "source": os.path.abspath(__file__),
+            "calls": self.records,
+            "slowest_lines": slowest,
+        }
+        with open(os.path.join(directory, name + ".json"), "w") as f:
+            json.dump(report, f, indent=1)
+        with open(os.path.join(directory, name + ".csv"), "w", newline="") as f:
+            fields = ["index", "kind", "line", "animations", "rendered", "frames"]
+            fields += ["total", *PROFILE_STAGES, "other", "pipe", "mobjects", "family"]
+            writer = csv.DictWriter(f, fields)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+
+# Frames go to ffmpeg from a thread, so that piping one frame overlaps with
+# drawing the next: write_frame copies the camera's pixels into a free
+# slot of a fixed ring of buffers and returns, and the thread writes full
+# slots to the pipe of the partial movie being recorded and hands them
+# back. When every slot is full, drawing waits for ffmpeg, so memory stays
+# at FRAME_QUEUE_SLOTS frames however long the scene is. A partial movie
+# is only closed once all its frames are through.
+FRAME_QUEUE_SLOTS = 8
+
+
+class _FrameQueue:
+    def __init__(self, file_writer, slots=FRAME_QUEUE_SLOTS):
+        self.file_writer = file_writer
+        self.slots = slots
+        self.buffers = []
+        self.free = queue.Queue()
+        self.full = queue.Queue()
+        self.error = None
+        # seconds the thread has spent in pipe writes, for the profiler
+        self.pipe_seconds = 0.0
+        self._write_frame = file_writer.write_frame
+        self._close_movie_pipe = file_writer.close_movie_pipe
+        file_writer.write_frame = self.write_frame
+        file_writer.close_movie_pipe = self.close_movie_pipe
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            slot, pipe, count = self.full.get()
+            start = time.perf_counter()
+            try:
+                for _ in range(count if self.error is None else 0):
+                    pipe.write(memoryview(self.buffers[slot].reshape(-1)))
+            except Exception as e:
+                self.error = e
+            self.pipe_seconds += time.perf_counter() - start
+            self.free.put(slot)
+            self.full.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def write_frame(self, frame, num_frames=1):
+        process = getattr(self.file_writer, "writing_process", None)
+        if process is None or process.stdin.closed or not isinstance(frame, np.ndarray):
+            if num_frames == 1:
+                return self._write_frame(frame)
+            return self._write_frame(frame, num_frames=num_frames)
+        self._check()
+        if not self.buffers or self.buffers[0].shape != frame.shape:
+            self._drain()
+            self.buffers = [np.empty_like(frame) for _ in range(self.slots)]
+            self.free = queue.Queue()
+            for slot in range(self.slots):
+                self.free.put(slot)
+        slot = self._next_slot()
+        np.copyto(self.buffers[slot], frame)
+        self.full.put((slot, process.stdin, num_frames))
+
+    def _next_slot(self):
+        return self.free.get()
+
+    def _drain(self):
+        self.full.join()
+
+    def close_movie_pipe(self, *args, **kwargs):
+        self._drain()
+        self._check()
+        return self._close_movie_pipe(*args, **kwargs)
+
+
+# manim draws the mobjects a play() leaves alone once, as the background
+# its frames start from, but it does so again at the start of every play().
+# Slides keep the same backdrop (axes, grids, dimmed halves) for many plays
+# in a row, so the image is kept and reused for as long as the static
+# mobjects and the camera stay the same, compared by a digest of their
+# points and style.
+_STATIC_STYLE_ATTRS = (
+    "stroke_width",
+    "background_stroke_width",
+    "sheen_factor",
+    "joint_type",
+    "z_index",
+)
+_STATIC_ARRAY_ATTRS = (
+    "points",
+    "fill_rgbas",
+    "stroke_rgbas",
+    "background_stroke_rgbas",
+    "sheen_direction",
+    "rgbas",
+    "pixel_array",
+)
+
+
+def _camera_state(camera):
+    return (
+        camera.pixel_width,
+        camera.pixel_height,
+        camera.frame_width,
+        camera.frame_height,
+        tuple(camera.frame_center),
+        str(camera.background_color),
+        camera.background_opacity,
+    )
+
+
+def _static_layer_key(camera, mobjects):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr(_camera_state(camera)).encode())
+    for mobject in extract_mobject_family_members(
+        mobjects, only_those_with_points=True
+    ):
+        style = [getattr(mobject, attr, None) for attr in _STATIC_STYLE_ATTRS]
+        digest.update(repr((type(mobject).__name__, style)).encode())
+        for attr in _STATIC_ARRAY_ATTRS:
+            value = getattr(mobject, attr, None)
+            if isinstance(value, np.ndarray):
+                digest.update(np.ascontiguousarray(value).data)
+    return digest.digest()
+
+
+class _StaticLayerCache:
+    def __init__(self, renderer):
+        self.renderer = renderer
+        self.key = None
+        self.image = None
+        self._save_static_frame_data = renderer.save_static_frame_data
+        renderer.save_static_frame_data = self.save_static_frame_data
+
+    def save_static_frame_data(self, scene, static_mobjects):
+        if not static_mobjects:
+            return self._save_static_frame_data(scene, static_mobjects)
+        key = _static_layer_key(self.renderer.camera, static_mobjects)
+        if key != self.key:
+            self._save_static_frame_data(scene, static_mobjects)
+            self.key = key
+            self.image = self.renderer.static_image
+        self.renderer.static_image = self.image
+        return self.image
+
+
+# Frames of a play() in which only something small moves (Indicate,
+# Circumscribe, IndicateEdges) are redrawn only inside the pixel box of
+# the moving mobjects, joined with the box they covered on the previous
+# frame: the static image is copied back into that rectangle and cairo is
+# clipped to it, the rest of the frame is left as it was. The first frame
+# of each play() is drawn whole, as is any frame whose box would be more
+# than DIRTY_RECT_MAX_FRACTION of the frame or where the camera moved.
+DIRTY_RECT_MAX_FRACTION = 0.25
+
+
+class _DirtyRectangles:
+    def __init__(self, renderer, max_fraction=DIRTY_RECT_MAX_FRACTION):
+        self.renderer = renderer
+        self.max_fraction = max_fraction
+        # (num_plays, camera state, box drawn over the static image)
+        self.drawn = None
+        self._update_frame = renderer.update_frame
+        renderer.update_frame = self.update_frame
+
+    # x0, y0, x1, y1 in pixels, padded for stroke width and antialiasing
+    def _pixel_box(self, camera, mobjects):
+        family = extract_mobject_family_members(mobjects, only_those_with_points=True)
+        if not family:
+            return None
+        points = np.concatenate([mobject.points for mobject in family])
+        width = max(
+            max(
+                getattr(mobject, "stroke_width", 0) or 0,
+                getattr(mobject, "background_stroke_width", 0) or 0,
+            )
+            for mobject in family
+        )
+        scale = camera.pixel_width / camera.frame_width
+        pad = width * max(0.01 * scale, 1) + 2
+        x = (points[:, 0] - camera.frame_center[0]) * scale + camera.pixel_width / 2
+        y = (
+            camera.pixel_height / 2
+            - (points[:, 1] - camera.frame_center[1])
+            * camera.pixel_height
+            / camera.frame_height
+        )
+        return (
+            max(0, int(x.min() - pad)),
+            max(0, int(y.min() - pad)),
+            min(camera.pixel_width, int(np.ceil(x.max() + pad))),
+            min(camera.pixel_height, int(np.ceil(y.max() + pad))),
+        )
+
+    def update_frame(
+        self,
+        scene,
+        mobjects=None,
+        include_submobjects=True,
+        ignore_skipping=True,
+        **kwargs,
+    ):
+        renderer = self.renderer
+        if renderer.skip_animations and not ignore_skipping:
+            return
+        kwargs.update(
+            include_submobjects=include_submobjects, ignore_skipping=ignore_skipping
+        )
+        camera = renderer.camera
+        static = renderer.static_image
+        state = (renderer.num_plays, _camera_state(camera))
+        drawn, self.drawn = self.drawn, None
+        if (
+            not mobjects
+            or static is None
+            or static.shape != camera.pixel_array.shape
+            or drawn is None
+            or drawn[:2] != state
+        ):
+            result = self._update_frame(scene, mobjects, **kwargs)
+            if mobjects and static is not None:
+                self.drawn = (*state, self._pixel_box(camera, mobjects))
+            return result
+        box = self._pixel_box(camera, mobjects)
+        previous = drawn[2]
+        if box is None or previous is None:
+            box = box or previous
+        else:
+            box = (
+                min(box[0], previous[0]),
+                min(box[1], previous[1]),
+                max(box[2], previous[2]),
+                max(box[3], previous[3]),
+            )
+        area = camera.pixel_width * camera.pixel_height
+        if (
+            box is None
+            or (box[2] - box[0]) * (box[3] - box[1]) > self.max_fraction * area
+        ):
+            result = self._update_frame(scene, mobjects, **kwargs)
+            self.drawn = (*state, self._pixel_box(camera, mobjects))
+            return result
+
+        x0, y0, x1, y1 = box
+        camera.pixel_array[y0:y1, x0:x1] = static[y0:y1, x0:x1]
+        ctx = camera.get_cairo_context(camera.pixel_array)
+        matrix = ctx.get_matrix()
+        ctx.identity_matrix()
+        ctx.reset_clip()
+        ctx.rectangle(x0, y0, x1 - x0, y1 - y0)
+        ctx.clip()
+        ctx.set_matrix(matrix)
+        try:
+            del kwargs["ignore_skipping"]
+            camera.capture_mobjects(mobjects, **kwargs)
+        finally:
+            ctx.reset_clip()
+        self.drawn = (*state, self._pixel_box(camera, mobjects))
+
+
+# A preview saves `samples` evenly spaced frames of every play() numbered
+# first to last (the last one at the end of the animation) as PNGs in
+# directory, named <slide>-<play>-<sample>.png; see render.py --preview.
+Preview = namedtuple(
+    "Preview", ["samples", "directory", "first", "last"], defaults=(1, None, 0, None)
+)
+
+
 class MyScene(Scene):
-    def __init__(self, *args, **kwargs):
-        super(MyScene, self).__init__(*args, **kwargs)
+    # manim already keys each play()/wait() (and so each pause()) on the
+    # mobject state going into it plus the animation parameters, and reuses
+    # the partial movie when that hash is unchanged. It only keeps 100 of
+    # them per scene though, and the longest scenes here make more calls
+    # than that, so their first segments were evicted on every render.
+    max_files_cached = 1000
+
+    # dry_run builds the scene without drawing or writing anything: each
+    # play() begins its animations and goes straight to finish(), with no
+    # frames in between. TeX is still compiled (or taken from the cache),
+    # since scenes index into the glyphs. See render.py --check. A preview
+    # is a dry run that draws just the frames it samples. Setting
+    # config.dry_run also turns off the movie and image outputs, so the
+    # whole config is put back once render() is done, the way tempconfig
+    # does, whether or not construct() raised.
+    def __init__(self, *args, dry_run=False, preview=None, **kwargs):
+        config.max_files_cached = max(config.max_files_cached, self.max_files_cached)
+        # every process rendering a slice of the scene has to replay
+        # construct() into exactly the same state
+        kwargs.setdefault("random_seed", 0)
+        dry_run = dry_run or preview is not None
+        self.config_before = None
+        if dry_run:
+            self.config_before = config.copy()
+            config.dry_run = True
+            kwargs["skip_animations"] = True
+        try:
+            super(MyScene, self).__init__(*args, **kwargs)
+        except BaseException:
+            self._restore_config()
+            raise
+        self.dry_run = dry_run
+        self.preview = preview
+        if dry_run:
+            # a skipped play() still rasterizes the static mobjects
+            self._draw_frame = self.renderer.update_frame
+            self.renderer.update_frame = lambda *args, **kwargs: None
+        elif config.renderer == "cairo":
+            self.frame_queue = _FrameQueue(self.renderer.file_writer)
+            self.static_layer = _StaticLayerCache(self.renderer)
+            self.dirty_rectangles = _DirtyRectangles(self.renderer)
+        # animation numbers at which a new slide starts, see render.py --split
+        self.pause_indices = []
+        # seconds of video played so far
+        self.timeline = 0.0
+        self.profiler = _PlayProfiler(self) if PROFILE_DIR else None
+
+    def setup(self):
+        precompile_tex(type(self))
 
     def pause(self):
         self.wait(0.25)
+        self.pause_indices.append(self.renderer.num_plays)
+
+    def play(self, *args, **kwargs):
+        if self.profiler is None:
+            super().play(*args, **kwargs)
+        else:
+            self.profiler.play(super().play, args, kwargs)
+        self.timeline += self.get_run_time(self.animations)
+
+    def play_internal(self, skip_rendering=False):
+        if not self.dry_run:
+            return super().play_internal(skip_rendering)
+        self.duration = self.get_run_time(self.animations)
+        if self._previewing() and self.duration > 0:
+            times = np.linspace(0, self.duration, self.preview.samples + 1)[1:]
+            for sample, t in enumerate(times):
+                self.update_to_time(t)
+                self._save_preview_frame(sample)
+        for animation in self.animations:
+            animation.finish()
+            animation.clean_up_from_scene(self)
+        # one step for the whole animation, as skip_animations does
+        self.update_mobjects(self.duration)
+        self.renderer.static_image = None
+
+    def _previewing(self):
+        if self.preview is None:
+            return False
+        index = self.renderer.num_plays
+        last = self.preview.last
+        return self.preview.first <= index and (last is None or index <= last)
+
+    def _save_preview_frame(self, sample):
+        # with update_frame stubbed out, manim's static image is whatever
+        # the camera last held, i.e. the previous sample; draw from scratch
+        self.renderer.static_image = None
+        self._draw_frame(self)
+        name = f"{len(self.pause_indices):03d}-{self.renderer.num_plays:05d}"
+        path = os.path.join(self.preview.directory, f"{name}-{sample}.png")
+        os.makedirs(self.preview.directory, exist_ok=True)
+        Image.fromarray(self.renderer.get_frame()).save(path)
+
+    # What a dry run reports for the scene, at the end of construct().
+    def get_stats(self):
+        return {
+            "plays": self.renderer.num_plays,
+            "pauses": len(self.pause_indices),
+            "seconds": self.timeline,
+            "mobjects": len(self.mobjects),
+            "family": len(self.get_mobject_family_members()),
+        }
+
+    def tear_down(self):
+        super().tear_down()
+        if self.profiler is not None:
+            self.profiler.write(PROFILE_DIR)
+
+    # manim skips tear_down() when construct() raises, and still reads the
+    # outputs from the config after it, in scene_finished()
+    def render(self, *args, **kwargs):
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            self._restore_config()
+
+    def _restore_config(self):
+        if self.config_before is not None:
+            config.update(self.config_before)
+            self.config_before = None
 
 
 def get_bounding_rect(mobject, buff=0, **kwargs):
@@ -72,6 +852,189 @@ class Blink(Transform):
         return target
 
 
+# Many straight edges drawn as subpaths of one VMobject, so a large graph
+# costs the renderer one mobject per edge style instead of one per edge (or
+# per dash). Edge i owns points edge_bounds[i]:edge_bounds[i + 1], and
+# point_owner maps each point back to its edge.
+class EdgeBatch(VMobject, metaclass=ConvertToOpenGL):
+    def __init__(self, buff=0, dash_length=None, dashed_ratio=0.4, **kwargs):
+        super().__init__(**kwargs)
+        self.buff = buff
+        self.dash_length = dash_length
+        self.dashed_ratio = dashed_ratio
+        self.set_edges([], np.zeros((0, 2, 3)))
+
+    def set_edges(self, edges, ends):
+        ends = np.array(ends, dtype=float).reshape(-1, 2, 3)
+        direction = ends[:, 1] - ends[:, 0]
+        length = np.linalg.norm(direction, axis=1)
+        # same as Line(buff=...): shorten both ends unless that would flip it
+        shorten = length > 2 * self.buff
+        step = np.zeros_like(direction)
+        step[shorten] = direction[shorten] * (self.buff / length[shorten])[:, None]
+        ends[:, 0] += step
+        ends[:, 1] -= step
+        length = np.linalg.norm(ends[:, 1] - ends[:, 0], axis=1)
+
+        if self.dash_length is None:
+            num_dashes = np.ones(len(ends), dtype=int)
+        else:
+            period = self.dash_length / self.dashed_ratio
+            num_dashes = np.maximum(1, np.ceil(length / period)).astype(int)
+        # the first dash starts and the last one ends exactly on the endpoints
+        owner = np.repeat(np.arange(len(ends)), num_dashes)
+        first_dash = np.cumsum(num_dashes) - num_dashes
+        j = np.arange(len(owner)) - first_dash[owner]
+        n = num_dashes[owner]
+        ratio = np.where(n > 1, self.dashed_ratio, 1.0)
+        dash = ratio / n
+        gap = np.where(n > 1, (1 - ratio) / np.maximum(n - 1, 1), 0.0)
+        a = j * (dash + gap)
+
+        per_curve = getattr(self, "n_points_per_cubic_curve", None)
+        per_curve = per_curve or self.n_points_per_curve
+        fractions = a[:, None] + dash[:, None] * np.linspace(0, 1, per_curve)
+        start = ends[owner, 0][:, None]
+        points = start + fractions[:, :, None] * (ends[owner, 1][:, None] - start)
+
+        self.edges = list(edges)
+        self.index = {edge: i for (i, edge) in enumerate(self.edges)}
+        self.edge_bounds = np.concatenate([[0], np.cumsum(num_dashes)]) * per_curve
+        self.point_owner = np.repeat(owner, per_curve)
+        self.set_points(points.reshape(-1, 3))
+        return self
+
+    def get_edge_ends(self):
+        if not self.edges:
+            return np.zeros((0, 2, 3))
+        return np.stack(
+            [self.points[self.edge_bounds[:-1]], self.points[self.edge_bounds[1:] - 1]],
+            axis=1,
+        )
+
+    # A separate VMobject with just these edges, for highlighting some of them
+    # in their own style; a single VMobject only has one.
+    def extract(self, edges, **style):
+        points = [
+            self.points[self.edge_bounds[i] : self.edge_bounds[i + 1]]
+            for i in (self.index[edge] for edge in edges)
+        ]
+        result = VMobject().match_style(self).set_style(**style)
+        if points:
+            result.set_points(np.concatenate(points))
+        return result
+
+
+def _line_segments(line):
+    if isinstance(line, EdgeBatch):
+        return [line], line.get_edge_ends(), [line.point_owner]
+    parts = line.family_members_with_points()
+    owners = [np.zeros(len(part.points), dtype=int) for part in parts]
+    return parts, np.array([line.get_start_and_end()]), owners
+
+
+def _flatten_points(mobjects):
+    parts = []
+    owners = []
+    for i, mobject in enumerate(mobjects):
+        for part in mobject.family_members_with_points():
+            parts.append(part)
+            owners.append(np.full(len(part.points), i))
+    bounds = np.cumsum([0] + [len(part.points) for part in parts])
+    if not parts:
+        return parts, bounds, np.zeros((0, 3)), np.zeros(0, dtype=int)
+    points = np.concatenate([part.points for part in parts])
+    return parts, bounds, points, np.concatenate(owners)
+
+
+# Moves dots and straight edge lines to new positions as a single animation
+# rather than one .animate per mobject. lines may hold Line/DashedLine
+# mobjects, each one segment, or EdgeBatches, one segment per edge;
+# line_targets has the new endpoints of every segment in that order. All
+# their points live in two flat arrays for the duration, which the
+# mobjects' own points are views into: a dot's points just translate, and
+# each point of a line stays at the same fraction of the way between its
+# endpoints, so a frame is one lerp of the centers/endpoints, one gather
+# and one write for everything.
+class GraphMotion(Animation):
+    def __init__(
+        self,
+        dots: Sequence["Mobject"],
+        dot_targets: np.ndarray,
+        lines: Sequence["Mobject"],
+        line_targets: np.ndarray,
+        **kwargs,
+    ) -> None:
+        self.dots = list(dots)
+        self.dot_targets = np.asarray(dot_targets, dtype=float).reshape(-1, 3)
+        self.lines = list(lines)
+        self.line_targets = np.asarray(line_targets, dtype=float).reshape(-1, 2, 3)
+        super().__init__(VGroup(*self.dots, *self.lines), **kwargs)
+
+    def begin(self) -> None:
+        centers = np.array([dot.get_center() for dot in self.dots]).reshape(-1, 3)
+        parts, bounds, self.dot_points, owner = _flatten_points(self.dots)
+        self.dot_flat, self.dot_loose = self._bind(parts, bounds, self.dot_points)
+        self.dot_offsets = (self.dot_targets - centers)[owner]
+
+        parts = []
+        starts = []
+        owners = []
+        num_segments = 0
+        for line in self.lines:
+            line_parts, ends, line_owners = _line_segments(line)
+            parts += line_parts
+            starts.append(ends)
+            owners += [owner + num_segments for owner in line_owners]
+            num_segments += len(ends)
+        self.line_starts = np.concatenate(starts or [np.zeros((0, 2, 3))])
+        self.line_owner = np.concatenate(owners or [np.zeros(0, dtype=int)])
+        bounds = np.cumsum([0] + [len(part.points) for part in parts])
+        points = np.concatenate([part.points for part in parts] or [np.zeros((0, 3))])
+        self.line_flat, self.line_loose = self._bind(parts, bounds, points)
+        start = self.line_starts[self.line_owner, 0]
+        direction = self.line_starts[self.line_owner, 1] - start
+        length = (direction * direction).sum(axis=1)
+        self.line_fractions = np.divide(
+            ((points - start) * direction).sum(axis=1),
+            length,
+            out=np.zeros_like(length),
+            where=length > 0,
+        )[:, None]
+        super().begin()
+
+    def create_starting_mobject(self) -> "Mobject":
+        # the starting state is the arrays above, no need to copy every mobject
+        return Mobject()
+
+    def interpolate_mobject(self, alpha: float) -> None:
+        alpha = self.rate_func(alpha)
+        np.add(self.dot_points, alpha * self.dot_offsets, out=self.dot_flat)
+        ends = self.line_starts + alpha * (self.line_targets - self.line_starts)
+        start = ends[self.line_owner, 0]
+        end = ends[self.line_owner, 1]
+        np.add(start, self.line_fractions * (end - start), out=self.line_flat)
+        for flat, loose in (
+            (self.dot_flat, self.dot_loose),
+            (self.line_flat, self.line_loose),
+        ):
+            for part, a, b in loose:
+                part.set_points(flat[a:b])
+
+    # Points each part at its slice of one new array, returning the array
+    # and the parts that keep a copy instead (OpenGL mobjects store their
+    # own), which still have to be set frame by frame.
+    @staticmethod
+    def _bind(parts, bounds, points):
+        flat = points.copy()
+        loose = []
+        for part, a, b in zip(parts, bounds, bounds[1:]):
+            part.points = flat[a:b]
+            if not np.shares_memory(part.points, flat):
+                loose.append((part, a, b))
+        return flat, loose
+
+
 class Path(VMobject, metaclass=ConvertToOpenGL):
     def __init__(self, *points: Sequence[float], color=BLUE, **kwargs):
         super().__init__(color=color, **kwargs)
@@ -84,6 +1047,53 @@ class Path(VMobject, metaclass=ConvertToOpenGL):
         )
 
 
+# Read-only set views of a Graph's edges and matched edges, as (label,
+# label) tuples in sorted order like the sets they replace. The Graph
+# itself keeps them as integer vertex ids; see Graph._append_edge.
+class EdgeView(AbstractSet):
+    def __init__(self, graph):
+        self.graph = graph
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
+    def _ids(self, edge):
+        try:
+            p1, p2 = edge
+            if p2 < p1:
+                return None
+            return self.graph.ids[p1], self.graph.ids[p2]
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def __contains__(self, edge):
+        ids = self._ids(edge)
+        return ids is not None and self.graph.has_edge_ids(*ids)
+
+    def __iter__(self):
+        labels = self.graph.labels
+        for u, v in zip(*self.graph.get_edge_ids()):
+            yield labels[u], labels[v]
+
+    def __len__(self):
+        return len(self.graph.get_edge_ids()[0])
+
+
+class MatchingView(EdgeView):
+    def __contains__(self, edge):
+        ids = self._ids(edge)
+        return ids is not None and tuple(sorted(ids)) in self.graph._matched
+
+    def __iter__(self):
+        labels = self.graph.labels
+        for u, v in self.graph._matched:
+            yield self.graph._edge_key(labels[u], labels[v])
+
+    def __len__(self):
+        return len(self.graph._matched)
+
+
 class Graph:
     def DefaultUnconnectedEdge(self, p1, p2, **kwargs):
         return DashedLine(
@@ -114,17 +1124,39 @@ class Graph:
         connected_edge=None,
         unconnected_edge=None,
     ):
+        if not isinstance(points, dict):
+            # just the labels: everything starts at ORIGIN, see apply_layout
+            points = {label: ORIGIN for label in points}
         self.points = {
             label: Dot(p, radius=0.15 * scale) for (label, p) in points.items()
         }
-        self.edges = set()
-        self.matching = set()
+        # vertex labels interned to dense ids, in the order of self.points
+        self.labels = list(self.points)
+        self.ids = {label: i for (i, label) in enumerate(self.labels)}
+        # edges as parallel arrays of ids, smaller label first; compacted
+        # (duplicates dropped) and indexed into CSR form on first lookup
+        self._edge_u = array("l")
+        self._edge_v = array("l")
+        self._csr = None
+        # matched edges as (id, id) pairs, smaller id first, plus mate[u], a
+        # partner of u or -1, and how many matched edges cover u (scenes do
+        # show edge sets that are not matchings)
+        self._matched = set()
+        self.mate = array("l", [-1] * len(self.labels))
+        self._matched_degree = array("l", [0] * len(self.labels))
+        self.edges = EdgeView(self)
+        self.matching = MatchingView(self)
         self.lines = {}
+        self._sub_groups = {}
+        self.weights = {}
+        # edges whose matched state changed since the last update_matching()
+        self.dirty = set()
         self.scale = scale
         self.solid_color = solid_color
         self.dashed_color = dashed_color
         self.connected_edge = connected_edge or self.DefaultConnectedEdge
         self.unconnected_edge = unconnected_edge or self.DefaultUnconnectedEdge
+        self._edge_array = None
 
     def get_group(self):
         return VGroup(
@@ -132,12 +1164,30 @@ class Graph:
             *self.points.values(),
         )
 
-    def get_sub_group(self, vertices):
-        points = [self.points[v] for v in vertices]
-        edges = [
-            self.lines[e] for e in self.edges if e[0] in vertices and e[1] in vertices
+    # The edges with both ends in vertices, found through the CSR index in
+    # O(sum of their degrees).
+    def induced_edges(self, vertices):
+        indptr, indices = self.get_csr()
+        inside = {self.ids[v] for v in vertices}
+        labels = self.labels
+        return [
+            self._edge_key(labels[u], labels[v])
+            for u in inside
+            for v in indices[indptr[u] : indptr[u + 1]].tolist()
+            if u < v and v in inside
         ]
-        return VGroup(*edges, *points)
+
+    # Scenes ask for the same subsets again and again, so their members are
+    # kept until an edge, vertex or line mobject changes. Each call still
+    # gets a VGroup of its own, which callers are free to rearrange.
+    def get_sub_group(self, vertices):
+        key = tuple(vertices)
+        members = self._sub_groups.get(key)
+        if members is None:
+            edges = [self.lines[e] for e in self.induced_edges(vertices)]
+            members = edges + [self.points[v] for v in vertices]
+            self._sub_groups[key] = members
+        return VGroup(*members)
 
     def draw_points(self, scene):
         scene.add(*self.points.values())
@@ -150,35 +1200,112 @@ class Graph:
         )
 
     def shift(self, delta, animate=True):
-        if animate:
-            return AnimationGroup(
-                *[
-                    p.animate.move_to(p.get_center() + delta)
-                    for p in self.points.values()
-                ],
-                *[
-                    l.animate.put_start_and_end_on(
-                        l.get_start() + delta, l.get_end() + delta
-                    )
-                    for l in self.lines.values()
-                ],
-            )
-
-        for p in self.points.values():
-            p.move_to(p.get_center() + delta)
-        for l in self.lines.values():
-            l.put_start_and_end_on(l.get_start() + delta, l.get_end() + delta)
-
-    def add_edge(self, p1, p2):
-        edge = tuple(sorted((p1, p2)))
-        self.edges.add(edge)
+        if not animate:
+            self.get_group().shift(delta)
+            return
+
+        dots = list(self.points.values())
+        lines = list(self.lines.values())
+        centers = np.array([dot.get_center() for dot in dots]).reshape(-1, 3)
+        ends = np.array([line.get_start_and_end() for line in lines]).reshape(-1, 2, 3)
+        return GraphMotion(dots, centers + delta, lines, ends + delta)
+
+    @staticmethod
+    def _edge_key(p1, p2):
+        return (p1, p2) if p1 <= p2 else (p2, p1)
+
+    def _append_edge(self, p1, p2, weight):
+        edge = self._edge_key(p1, p2)
+        self._edge_u.append(self.ids[edge[0]])
+        self._edge_v.append(self.ids[edge[1]])
+        self._csr = None
+        self._sub_groups.clear()
+        if weight is not None:
+            self.weights[edge] = weight
+        return edge
+
+    # Bulk add_edge by vertex id, for the file loaders: orients every edge
+    # smaller label first in one vectorized pass.
+    def _append_edges(self, u, v, weights=None):
+        u = np.asarray(u, dtype=np.int64)
+        v = np.asarray(v, dtype=np.int64)
+        n = len(self.labels)
+        rank = np.empty(n, dtype=np.int64)
+        rank[sorted(range(n), key=self.labels.__getitem__)] = np.arange(n)
+        swap = rank[u] > rank[v]
+        u, v = np.where(swap, v, u).tolist(), np.where(swap, u, v).tolist()
+        self._edge_u.extend(u)
+        self._edge_v.extend(v)
+        self._csr = None
+        self._sub_groups.clear()
+        labels = self.labels
+        if weights is not None:
+            self.weights.update(
+                ((labels[a], labels[b]), w) for (a, b, w) in zip(u, v, weights)
+            )
+        return [(labels[a], labels[b]) for (a, b) in zip(u, v)]
+
+    def add_edge_ids(self, u, v, weights=None):
+        for edge in self._append_edges(u, v, weights):
+            self.lines[edge] = self._make_edge(edge)
+        self._edge_array = None
+
+    def get_edge_ids(self):
+        self.get_csr()
+        return self._edge_u, self._edge_v
+
+    # (indptr, indices): the neighbours of vertex id u, ascending, are
+    # indices[indptr[u]:indptr[u + 1]]
+    def get_csr(self):
+        if self._csr is not None:
+            return self._csr
+        n = len(self.labels)
+        u = np.array(self._edge_u, dtype=np.int64)
+        v = np.array(self._edge_v, dtype=np.int64)
+        keys = u.astype(np.int64) * n + v
+        _, first = np.unique(keys, return_index=True)
+        if len(first) < len(keys):
+            keep = np.sort(first)
+            self._edge_u = array("l", u[keep].tolist())
+            self._edge_v = array("l", v[keep].tolist())
+            u, v = u[keep], v[keep]
+        src = np.concatenate([u, v])
+        dst = np.concatenate([v, u])
+        order = np.lexsort((dst, src))
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+        self._csr = (indptr, dst[order])
+        return self._csr
+
+    def has_edge_ids(self, u, v):
+        indptr, indices = self.get_csr()
+        row = indices[indptr[u] : indptr[u + 1]]
+        i = np.searchsorted(row, v)
+        return i < len(row) and row[i] == v
+
+    def neighbors(self, label):
+        indptr, indices = self.get_csr()
+        u = self.ids[label]
+        return [self.labels[v] for v in indices[indptr[u] : indptr[u + 1]]]
+
+    def add_edge(self, p1, p2, weight=None):
+        edge = self._append_edge(p1, p2, weight)
         line = self._make_edge(edge)
         self.lines[edge] = line
+        self._edge_array = None
 
     def add_point(self, label, p, hidden=False):
         self.points[label] = Dot(
             p, radius=0 if hidden else 0.15 * self.scale, z_index=100
         )
+        self._sub_groups.clear()
+        if label not in self.ids:
+            self.ids[label] = len(self.labels)
+            self.labels.append(label)
+            self.mate.append(-1)
+            self._matched_degree.append(0)
+            self._csr = None
+        self._edge_array = None
 
     def _make_edge(self, edge):
         p1 = self.points[edge[0]].get_center()
@@ -197,19 +1324,48 @@ class Graph:
         for edge in self.edges:
             scene.add(self.lines[edge])
 
+    def is_matched(self, p1, p2):
+        u, v = self.ids[p1], self.ids[p2]
+        return ((u, v) if u < v else (v, u)) in self._matched
+
     def match(self, p1, p2):
-        self.matching.add(tuple(sorted((p1, p2))))
+        u, v = self.ids[p1], self.ids[p2]
+        pair = (u, v) if u < v else (v, u)
+        if pair not in self._matched:
+            self._matched.add(pair)
+            self._matched_degree[u] += 1
+            self._matched_degree[v] += 1
+        self.mate[u] = v
+        self.mate[v] = u
+        self.dirty.add(self._edge_key(p1, p2))
 
     def unmatch(self, p1, p2):
-        self.matching.remove(tuple(sorted((p1, p2))))
+        u, v = self.ids[p1], self.ids[p2]
+        self._matched.remove((u, v) if u < v else (v, u))
+        for a, b in ((u, v), (v, u)):
+            self._matched_degree[a] -= 1
+            if self.mate[a] != b:
+                continue
+            self.mate[a] = -1
+            if self._matched_degree[a]:
+                # only when the matched edges did not form a matching
+                for x, y in self._matched:
+                    if a in (x, y):
+                        self.mate[a] = y if x == a else x
+                        break
+        self.dirty.add(self._edge_key(p1, p2))
 
     def update_matching(self, animated=True, fade=False):
         animations = []
-        for edge in self.edges:
+        dirty, self.dirty = self.dirty, set()
+        for edge in dirty:
+            if edge not in self.lines:
+                continue
             old_line = self.lines[edge]
             new_line = self._make_edge(edge)
             if old_line.__class__.__name__ != new_line.__class__.__name__:
                 self.lines[edge] = new_line
+                self._sub_groups.clear()
                 if animated:
                     if fade:
                         animations.append(FadeOut(old_line))
@@ -232,32 +1388,46 @@ class Graph:
 
         return animations if animated else None
 
+    def get_edge_array(self):
+        # (m, 2) vertex rows, in order of self.points, for each edge in
+        # self.lines; rebuilt only after vertices or edges are added
+        if self._edge_array is None:
+            index = {label: i for (i, label) in enumerate(self.points)}
+            edges = list(self.lines)
+            rows = np.array(
+                [[index[p1], index[p2]] for (p1, p2) in edges], dtype=int
+            ).reshape(-1, 2)
+            self._edge_array = (index, edges, rows)
+        return self._edge_array
+
     def rearrange(self, new_points, dont_stretch={}, animated=True):
         dont_stretch = set(tuple(sorted(x)) for x in dont_stretch)
-        edges = [
-            edge
-            for edge in self.edges
-            if edge[0] in new_points or edge[1] in new_points
-        ]
-        new_line_start_ends = [
-            (
-                new_points.get(edge[0], self.lines[edge].get_start()),
-                new_points.get(edge[1], self.lines[edge].get_end()),
-                edge,
-            )
-            for edge in edges
-        ]
+        index, edges, rows = self.get_edge_array()
+        moved = np.zeros(len(index), dtype=bool)
+        targets = np.zeros((len(index), 3))
+        for key, new_point in new_points.items():
+            moved[index[key]] = True
+            targets[index[key]] = new_point
+        touched = moved[rows].any(axis=1)
+        rows = rows[touched]
+        edges = [edges[i] for i in np.flatnonzero(touched)]
+        # an endpoint that does not move stays where the line ends now
+        ends = np.array([self.lines[edge].get_start_and_end() for edge in edges])
+        ends = np.where(moved[rows][:, :, None], targets[rows], ends.reshape(-1, 2, 3))
         if not animated:
-            for (start, end, edge) in new_line_start_ends:
+            for edge, (start, end) in zip(edges, ends):
                 self.lines[edge].put_start_and_end_on(start, end)
             for key, new_point in new_points.items():
                 self.points[key].move_to(new_point)
 
+        stretch = [i for (i, edge) in enumerate(edges) if edge not in dont_stretch]
         return AnimationGroup(
-            *[
-                self.points[key].animate.move_to(new_point)
-                for key, new_point in new_points.items()
-            ],
+            GraphMotion(
+                [self.points[key] for key in new_points],
+                targets[[index[key] for key in new_points]],
+                [self.lines[edges[i]] for i in stretch],
+                ends[stretch],
+            ),
             *[
                 Transform(
                     self.lines[edge],
@@ -267,12 +1437,24 @@ class Graph:
                         else self.unconnected_edge
                     )(start, end),
                 )
+                for (edge, (start, end)) in zip(edges, ends)
                 if edge in dont_stretch
-                else self.lines[edge].animate.put_start_and_end_on(start, end)
-                for (start, end, edge) in new_line_start_ends
             ],
         )
 
+    # Moves the vertices to a computed layout (see GRAPH_LAYOUTS). Without
+    # animation the edges are rebuilt outright, since a graph created
+    # without positions has all of them collapsed at ORIGIN.
+    def apply_layout(self, layout="force", animated=False, **kwargs):
+        positions = GRAPH_LAYOUTS[layout](self, **kwargs)
+        if animated:
+            return self.rearrange(positions)
+        for label, position in positions.items():
+            self.points[label].move_to(position)
+        for edge in self.lines:
+            self.lines[edge] = self._make_edge(edge)
+        self._sub_groups.clear()
+
     def highlight_path(self, *points):
         line_points = [self.points[x].get_center() for x in points]
         line = (
@@ -286,11 +1468,1237 @@ class Graph:
         for i in range(len(points) - 1):
             p1 = points[i]
             p2 = points[i + 1]
-            edge = (p1, p2)
-            if edge in self.matching:
-                self.unmatch(*edge)
+            if self.is_matched(p1, p2):
+                self.unmatch(p1, p2)
+            else:
+                self.match(p1, p2)
+
+
+# Below this many pixels across, BatchedGraph draws its vertices as one
+# point cloud and its edges as thin solid strokes (dashes that small would
+# only blur together anyway).
+LOD_MIN_DOT_PIXELS = 3
+LOD_EDGE_WIDTH = 1
+
+
+# Plays a BatchedGraph's edge changes, then hands the edges back to the
+# batches.
+class _EdgeSwap(AnimationGroup):
+    def __init__(self, graph, pieces, *animations, **kwargs):
+        super().__init__(*animations, **kwargs)
+        self.graph = graph
+        self.pieces = pieces
+
+    def clean_up_from_scene(self, scene):
+        super().clean_up_from_scene(scene)
+        scene.remove(*self.pieces)
+        self.graph.make_edges()
+
+
+# A Graph whose edges are packed into two EdgeBatches, one for matched and
+# one for unmatched edges, for graphs too large to animate edge by edge.
+# There are no per-edge mobjects (self.lines stays empty), so edges take
+# the default solid/dashed look and are highlighted through extract().
+class BatchedGraph(Graph):
+    # lod is "auto", "full" or "points"; "auto" picks one from the size a
+    # vertex would have on screen, see set_level_of_detail.
+    def __init__(
+        self, points, scale=1, solid_color=WHITE, dashed_color=WHITE, lod="auto"
+    ):
+        super().__init__(
+            points, scale=scale, solid_color=solid_color, dashed_color=dashed_color
+        )
+        self.solid_edges = EdgeBatch(
+            buff=0.15 * scale, stroke_width=10 * scale, stroke_color=solid_color
+        )
+        self.dashed_edges = EdgeBatch(
+            buff=0.15 * scale,
+            dash_length=0.1 * scale,
+            dashed_ratio=0.4,
+            stroke_width=10 * scale,
+            stroke_color=dashed_color,
+        )
+        self._batches_stale = False
+
+        self.lod = lod
+        self.camera_frame = None
+        self.coarse = False
+        self.vertex_cloud = PMobject()
+        self._cloud_points = np.zeros((0, 3))
+        # what the scene holds for the vertices: the dots, or the cloud
+        self.vertex_layer = Group(*self.points.values())
+        self.vertex_layer.add_updater(lambda _: self.set_level_of_detail())
+        self.set_level_of_detail()
+
+    def dot_pixels(self, frame_width=None):
+        if frame_width is None:
+            frame = self.camera_frame
+            frame_width = frame.width if frame is not None else config.frame_width
+        return 0.3 * self.scale * config.pixel_width / frame_width
+
+    # Switches between the dots and the point cloud. Called every frame by
+    # the vertex layer's updater; follow_camera makes "auto" go by a moving
+    # camera's frame instead of the configured frame width.
+    def set_level_of_detail(self, frame_width=None):
+        pixels = self.dot_pixels(frame_width)
+        if self.lod == "auto":
+            coarse = pixels < LOD_MIN_DOT_PIXELS
+        else:
+            coarse = self.lod == "points"
+        if coarse:
+            self.vertex_cloud.stroke_width = max(1, round(pixels))
+        if coarse != self.coarse:
+            self._sync_vertices()
+            self.coarse = coarse
+            if coarse:
+                self._cloud_points = np.zeros((0, 3))
+            self.vertex_layer.submobjects = (
+                [self.vertex_cloud] if coarse else list(self.points.values())
+            )
+            width = LOD_EDGE_WIDTH if coarse else 10 * self.scale
+            self.solid_edges.set_stroke(width=width)
+            self.dashed_edges.set_stroke(width=width)
+            self.dashed_edges.dash_length = None if coarse else 0.1 * self.scale
+            self.make_edges()
+        self._sync_vertices()
+        return self
+
+    def follow_camera(self, frame):
+        self.camera_frame = frame
+        return self.set_level_of_detail()
+
+    # While coarse, the dots are off screen but animations still move and
+    # recolour them, so the cloud copies them; a transform of the whole group
+    # moves the cloud instead, and that is copied back onto the dots.
+    def _sync_vertices(self):
+        if not self.coarse:
+            return
+        cloud = self.vertex_cloud
+        dots = list(self.points.values())
+        synced = len(cloud.points) == len(self._cloud_points) == len(dots)
+        if synced and not np.array_equal(cloud.points, self._cloud_points):
+            moved = cloud.points - self._cloud_points
+            for dot, delta in zip(dots, moved):
+                if delta.any():
+                    dot.shift(delta)
+        if not dots:
+            return
+        points = np.concatenate([dot.points for dot in dots])
+        starts = np.cumsum([0] + [len(dot.points) for dot in dots[:-1]])
+        low = np.minimum.reduceat(points, starts)
+        high = np.maximum.reduceat(points, starts)
+        centers = (low + high) / 2
+        rgbas = np.array(
+            [
+                color_to_rgba(dot.get_fill_color(), dot.get_fill_opacity())
+                for dot in dots
+            ]
+        ).reshape(-1, 4)
+        # hidden points have no radius
+        rgbas[:, 3] *= high[:, 0] > low[:, 0]
+        cloud.reset_points()
+        cloud.add_points(centers, rgbas=rgbas)
+        self._cloud_points = cloud.points.copy()
+
+    def _vertex_ends(self, edges):
+        index = {label: i for (i, label) in enumerate(self.points)}
+        centers = np.array([dot.get_center() for dot in self.points.values()])
+        rows = np.array([[index[p1], index[p2]] for (p1, p2) in edges], dtype=int)
+        return centers.reshape(-1, 3)[rows.reshape(-1, 2)]
+
+    # Leaving some edges out marks the batches stale, so the next use puts
+    # them back.
+    def make_edges(self, exclude=()):
+        exclude = set(exclude)
+        edges = [edge for edge in self.edges if edge not in exclude]
+        solid = [edge for edge in edges if edge in self.matching]
+        dashed = [edge for edge in edges if edge not in self.matching]
+        self.solid_edges.set_edges(solid, self._vertex_ends(solid))
+        self.dashed_edges.set_edges(dashed, self._vertex_ends(dashed))
+        self._batches_stale = bool(exclude)
+        self.dirty = set()
+
+    # The given edges alone, drawn as the matched or unmatched batch would.
+    def _edge_piece(self, edges, matched):
+        batch = self.solid_edges if matched else self.dashed_edges
+        piece = EdgeBatch(
+            buff=batch.buff,
+            dash_length=batch.dash_length,
+            dashed_ratio=batch.dashed_ratio,
+        ).match_style(batch)
+        return piece.set_edges(edges, self._vertex_ends(edges))
+
+    def _edge_batches(self):
+        self._sync_vertices()
+        # Transform pads the points it morphs between, which leaves a batch's
+        # points out of step with its edge_bounds; rebuild it in that case
+        if self._batches_stale or any(
+            len(batch.points) != batch.edge_bounds[-1]
+            for batch in (self.dashed_edges, self.solid_edges)
+        ):
+            self.make_edges()
+        return [self.dashed_edges, self.solid_edges]
+
+    def get_group(self):
+        if self.coarse:
+            return Group(*self._edge_batches(), self.vertex_layer)
+        return VGroup(*self._edge_batches(), *self.points.values())
+
+    def draw_points(self, scene):
+        scene.add(self.vertex_layer)
+
+    def get_sub_group(self, vertices):
+        edges = self.induced_edges(vertices)
+        return VGroup(
+            *[
+                batch.extract([e for e in edges if e in batch.index])
+                for batch in self._edge_batches()
+            ],
+            *[self.points[v] for v in vertices],
+        )
+
+    def draw_edges(self, scene):
+        scene.add(*self._edge_batches())
+
+    def apply_to_all(self, animation, **kwargs):
+        return AnimationGroup(
+            *[animation(batch) for batch in self._edge_batches()],
+            *[animation(p) for p in self.points.values()],
+            **kwargs,
+        )
+
+    def add_edge(self, p1, p2, weight=None):
+        self._append_edge(p1, p2, weight)
+        self._batches_stale = True
+
+    def add_edge_ids(self, u, v, weights=None):
+        self._append_edges(u, v, weights)
+        self._batches_stale = True
+
+    def apply_layout(self, layout="force", animated=False, **kwargs):
+        if animated:
+            return super().apply_layout(layout, animated=True, **kwargs)
+        super().apply_layout(layout, **kwargs)
+        self.make_edges()
+
+    def add_point(self, label, p, hidden=False):
+        self._sync_vertices()
+        old = self.points.get(label)
+        super().add_point(label, p, hidden=hidden)
+        self._batches_stale = True
+        if old in self.vertex_layer.submobjects:
+            self.vertex_layer.remove(old)
+        if not self.coarse:
+            self.vertex_layer.add(self.points[label])
+        self._sync_vertices()
+
+    # Moves the edges whose state changed from one batch to the other. When
+    # animated, the batches are rebuilt without those edges, and each one
+    # is animated on its own, as a separate piece, as Graph does with its
+    # lines (morphing whole batches would pair up unrelated edges); once
+    # played, the pieces go and the batches get the edges back.
+    def update_matching(self, animated=True, fade=False):
+        # the batches still hold what is on screen, even when stale
+        was_solid = set(self.solid_edges.index)
+        was_dashed = set(self.dashed_edges.index)
+        changed = [
+            edge
+            for edge in self.dirty
+            if (edge in was_solid and edge not in self.matching)
+            or (edge in was_dashed and edge in self.matching)
+        ]
+        if not animated or not changed:
+            self.make_edges()
+            return [] if animated else None
+        self.make_edges(exclude=changed)
+
+        matched = [edge for edge in changed if edge in self.matching]
+        unmatched = [edge for edge in changed if edge not in self.matching]
+        if fade:
+            old = [self._edge_piece(unmatched, True), self._edge_piece(matched, False)]
+            new = [self._edge_piece(matched, True), self._edge_piece(unmatched, False)]
+            old = [piece for piece in old if piece.edges]
+            new = [piece for piece in new if piece.edges]
+            animations = [FadeOut(piece) for piece in old]
+            animations += [FadeIn(piece) for piece in new]
+            return [_EdgeSwap(self, old + new, *animations)]
+        pieces = []
+        animations = []
+        for edge in matched:
+            old, new = self._edge_piece([edge], False), self._edge_piece([edge], True)
+            pieces += [old, new]
+            animations.append(
+                AnimationGroup(GrowFromCenter(new), FadeOut(old, run_time=0))
+            )
+        for edge in unmatched:
+            old, new = self._edge_piece([edge], True), self._edge_piece([edge], False)
+            pieces += [old, new]
+            animations.append(AnimationGroup(FadeIn(new), ShrinkToCenter(old)))
+        return [_EdgeSwap(self, pieces, *animations)]
+
+    def shift(self, delta, animate=True):
+        batches = self._edge_batches()
+        if not animate:
+            self.get_group().shift(delta)
+            return
+
+        dots = list(self.points.values())
+        centers = np.array([dot.get_center() for dot in dots]).reshape(-1, 3)
+        ends = np.concatenate([batch.get_edge_ends() for batch in batches])
+        return GraphMotion(dots, centers + delta, batches, ends + delta)
+
+    # Same as Graph.rearrange, except that every edge stretches: the batches
+    # keep their dash counts while moving, dont_stretch is accepted for
+    # compatibility only.
+    def rearrange(self, new_points, dont_stretch={}, animated=True):
+        batches = self._edge_batches()
+        index = {label: i for (i, label) in enumerate(self.points)}
+        moved = np.zeros(len(index), dtype=bool)
+        targets = np.zeros((len(index), 3))
+        for key, new_point in new_points.items():
+            moved[index[key]] = True
+            targets[index[key]] = new_point
+        ends = []
+        for batch in batches:
+            rows = np.array(
+                [[index[p1], index[p2]] for (p1, p2) in batch.edges], dtype=int
+            ).reshape(-1, 2)
+            ends.append(
+                np.where(moved[rows][:, :, None], targets[rows], batch.get_edge_ends())
+            )
+        dots = [self.points[key] for key in new_points]
+        dot_targets = targets[[index[key] for key in new_points]]
+        motion = GraphMotion(dots, dot_targets, batches, np.concatenate(ends))
+        if not animated:
+            motion.begin()
+            motion.finish()
+        return motion
+
+
+# Loaders for graphs stored in files. Each streams its file line by line
+# (or element by element for GraphML; .gz files are read through gzip),
+# collecting vertex labels and edge id arrays, and hands them to the graph
+# in one add_edge_ids call. Vertices sit at ORIGIN unless the file has
+# coordinates, so lay the graph out before drawing it. An optional
+# matching file lists one matched pair per line, written like the edges.
+class _GraphBuilder:
+    def __init__(self):
+        self.ids = {}
+        self.labels = []
+        self.positions = {}
+        self.u = array("l")
+        self.v = array("l")
+        self.weights = array("d")
+        self.weighted = False
+
+    def vertex(self, label):
+        i = self.ids.get(label)
+        if i is None:
+            i = self.ids[label] = len(self.labels)
+            self.labels.append(label)
+        return i
+
+    def edge(self, p1, p2, weight=None):
+        if p1 == p2:
+            return
+        self.u.append(self.vertex(p1))
+        self.v.append(self.vertex(p2))
+        self.weights.append(1 if weight is None else weight)
+        self.weighted = self.weighted or weight is not None
+
+    def build(self, graph_class, **kwargs):
+        graph = graph_class(
+            {label: self.positions.get(label, ORIGIN) for label in self.labels},
+            **kwargs,
+        )
+        graph.add_edge_ids(self.u, self.v, self.weights if self.weighted else None)
+        return graph
+
+
+def _open_text(path, mode="rt"):
+    if str(path).endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _data_lines(f, comments="#%"):
+    for line in f:
+        fields = line.split()
+        if fields and fields[0][0] not in comments:
+            yield fields
+
+
+def _read_dimacs(f, builder):
+    for line in f:
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0] == "p":
+            for i in range(1, int(fields[2]) + 1):
+                builder.vertex(i)
+        elif fields[0] in ("e", "a"):
+            weight = float(fields[3]) if len(fields) > 3 else None
+            builder.edge(int(fields[1]), int(fields[2]), weight)
+    return int, int
+
+
+def _read_edge_list(f, builder):
+    for fields in _data_lines(f):
+        weight = float(fields[2]) if len(fields) > 2 else None
+        builder.edge(fields[0], fields[1], weight)
+    return str, str
+
+
+# Symmetric matrices are read as graphs on their rows; any other matrix as
+# the bipartite graph of rows r1.. against columns c1.., which is what a
+# matching of a sparse matrix usually means.
+def _read_matrix_market(f, builder):
+    header = next(f).split()
+    if header[:3] != ["%%MatrixMarket", "matrix", "coordinate"]:
+        raise ValueError("Only coordinate Matrix Market files describe graphs")
+    field, symmetry = header[3], header[4]
+    sizes = next(_data_lines(f, "%"))
+    rows, cols = int(sizes[0]), int(sizes[1])
+    if symmetry == "general":
+        row, col = (lambda i: f"r{i}"), (lambda j: f"c{j}")
+    else:
+        row = col = int
+    for i in range(1, rows + 1):
+        builder.vertex(row(i))
+    for j in range(1, cols + 1):
+        builder.vertex(col(j))
+    for fields in _data_lines(f, "%"):
+        weight = float(fields[2]) if field != "pattern" else None
+        builder.edge(row(int(fields[0])), col(int(fields[1])), weight)
+    return (lambda token: row(int(token))), (lambda token: col(int(token)))
+
+
+def _read_graphml(f, builder):
+    keys = {}
+    parent = None
+    for event, element in ElementTree.iterparse(f, events=("start", "end")):
+        tag = element.tag.rpartition("}")[2]
+        if event == "start":
+            if tag == "graph":
+                parent = element
+            continue
+        if tag == "key":
+            keys[element.get("id")] = element.get("attr.name")
+            continue
+        if tag not in ("node", "edge"):
+            continue
+        data = {
+            keys.get(child.get("key")): child.text
+            for child in element
+            if child.tag.rpartition("}")[2] == "data"
+        }
+        if tag == "node":
+            label = element.get("id")
+            builder.vertex(label)
+            if "x" in data and "y" in data:
+                builder.positions[label] = [float(data["x"]), float(data["y"]), 0]
+        else:
+            weight = float(data["weight"]) if "weight" in data else None
+            builder.edge(element.get("source"), element.get("target"), weight)
+        # drop what has been read so the tree never holds the whole file
+        parent.clear()
+    return str, str
+
+
+GRAPH_READERS = {
+    "dimacs": _read_dimacs,
+    "edgelist": _read_edge_list,
+    "mtx": _read_matrix_market,
+    "graphml": _read_graphml,
+}
+GRAPH_EXTENSIONS = {
+    ".col": "dimacs",
+    ".dimacs": "dimacs",
+    ".gr": "dimacs",
+    ".mtx": "mtx",
+    ".graphml": "graphml",
+}
+
+
+def load_graph(path, format=None, matching=None, graph_class=None, **kwargs):
+    if format is None:
+        _, extension = os.path.splitext(str(path).removesuffix(".gz"))
+        format = GRAPH_EXTENSIONS.get(extension.lower(), "edgelist")
+    builder = _GraphBuilder()
+    mode = "rb" if format == "graphml" else "rt"
+    with _open_text(path, mode) as f:
+        first, second = GRAPH_READERS[format](f, builder)
+    graph = builder.build(graph_class or BatchedGraph, **kwargs)
+    if matching is not None:
+        with _open_text(matching) as f:
+            for fields in _data_lines(f):
+                # DIMACS solutions put an "m" in front of each pair
+                if fields[0] == "m":
+                    fields = fields[1:]
+                graph.match(first(fields[0]), second(fields[1]))
+    return graph
+
+
+# Layouts for graphs built without coordinates. Each returns a position
+# per label, scaled to fit a width x height box centred on ORIGIN.
+def _fit_layout(graph, xy, size):
+    xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+    if len(xy):
+        xy = xy - (xy.min(axis=0) + xy.max(axis=0)) / 2
+        span = np.abs(xy).max(axis=0) * 2
+        scale = min((size[i] / span[i] for i in range(2) if span[i] > 0), default=1)
+        xy *= scale
+    return {label: [x, y, 0] for (label, (x, y)) in zip(graph.labels, xy.tolist())}
+
+
+def circular_layout(graph, size=(7, 7)):
+    angles = pi / 2 - 2 * pi * np.arange(len(graph.labels)) / len(graph.labels)
+    return _fit_layout(graph, np.stack([np.cos(angles), np.sin(angles)], 1), size)
+
+
+# Left side in one column, right side in the other, with each right vertex
+# placed at the mean height of its neighbours to cut down on crossings.
+def bipartite_layout(graph, left=None, size=(8, 6)):
+    if left is None:
+        left, _ = bipartition(graph)
+    ids = graph.ids
+    xy = np.zeros((len(graph.labels), 2))
+    on_left = np.zeros(len(graph.labels), dtype=bool)
+    on_left[[ids[label] for label in left]] = True
+    left_ids = np.flatnonzero(on_left)
+    right_ids = np.flatnonzero(~on_left)
+    xy[left_ids, 0] = -1
+    xy[left_ids, 1] = -np.arange(len(left_ids))
+    xy[right_ids, 0] = 1
+
+    indptr, indices = graph.get_csr()
+    degree = np.diff(indptr)[right_ids]
+    owner = np.repeat(np.arange(len(right_ids)), degree)
+    neighbours = np.concatenate(
+        [indices[indptr[u] : indptr[u + 1]] for u in right_ids] or [[]]
+    ).astype(int)
+    height = np.bincount(owner, xy[neighbours, 1], len(right_ids))
+    height = np.where(degree > 0, height / np.maximum(degree, 1), -len(left_ids))
+    xy[right_ids[np.argsort(-height, kind="stable")], 1] = -np.arange(len(right_ids))
+    return _fit_layout(graph, xy, size)
+
+
+def _spread_bits(v):
+    v = v.astype(np.uint64)
+    for shift, mask in (
+        (8, 0x00FF00FF),
+        (4, 0x0F0F0F0F),
+        (2, 0x33333333),
+        (1, 0x55555555),
+    ):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+# Barnes-Hut repulsion, k^2 / d from every other vertex, with the quadtree
+# built level by level from the vertices' Morton codes: the cells of a
+# level are the distinct code prefixes, and a cell's children are a
+# contiguous run of the next level's sorted prefixes. The traversal keeps
+# a frontier of (vertex, cell) pairs for all vertices at once, accepting a
+# cell as a single mass once it is small enough seen from the vertex.
+def _repulsion(xy, k, theta, depth=12):
+    n = len(xy)
+    low = xy.min(axis=0)
+    span = max((xy.max(axis=0) - low).max(), 1e-9)
+    cells = 1 << depth
+    q = np.minimum(((xy - low) / span * cells).astype(np.int64), cells - 1)
+    code = _spread_bits(q[:, 0]) | (_spread_bits(q[:, 1]) << np.uint64(1))
+
+    levels = []
+    for level in range(depth + 1):
+        prefix = code >> np.uint64(2 * (depth - level))
+        keys, cell = np.unique(prefix, return_inverse=True)
+        mass = np.bincount(cell, minlength=len(keys)).astype(float)
+        center = np.stack(
+            [np.bincount(cell, xy[:, d], len(keys)) for d in range(2)], axis=1
+        )
+        levels.append((keys, cell, mass, center / mass[:, None]))
+    children = []
+    for level in range(depth):
+        parents = np.searchsorted(
+            levels[level][0], levels[level + 1][0] >> np.uint64(2)
+        )
+        count = np.bincount(parents, minlength=len(levels[level][0]))
+        children.append((np.cumsum(count) - count, count))
+
+    force = np.zeros((n, 2))
+    points = np.arange(n)
+    nodes = np.zeros(n, dtype=np.int64)
+    for level in range(depth + 1):
+        _, cell, mass, center = levels[level]
+        p = xy[points]
+        m = mass[nodes]
+        delta = p - center[nodes]
+        # leave the vertex itself out of the cell it is in
+        own = np.flatnonzero(cell[points] == nodes)
+        m[own] -= 1
+        delta[own] = (
+            (p[own] - center[nodes[own]])
+            * (m[own] + 1)[:, None]
+            / np.maximum(m[own], 1)[:, None]
+        )
+        dist2 = np.maximum(np.einsum("ij,ij->i", delta, delta), (span * 1e-6) ** 2)
+        size = span / (1 << level)
+        # a cell holding one vertex is exact at any size
+        accept = size * size < theta * theta * dist2
+        accept[own] = False
+        accept |= m <= 1
+        if level == depth:
+            accept[:] = True
+        push = np.flatnonzero(accept & (m > 0))
+        scale = k * k * m[push] / dist2[push]
+        for d in range(2):
+            force[:, d] += np.bincount(points[push], delta[push, d] * scale, n)
+        expand = ~accept
+        if level == depth or not expand.any():
+            break
+        first, count = children[level]
+        count = count[nodes[expand]]
+        points = np.repeat(points[expand], count)
+        start = np.repeat(first[nodes[expand]], count)
+        offset = np.arange(len(points)) - np.repeat(np.cumsum(count) - count, count)
+        nodes = start + offset
+    return force
+
+
+# Fruchterman-Reingold with Barnes-Hut repulsion, so an iteration costs
+# O(n log n + m) and runs as a handful of NumPy passes. By default the
+# number of iterations shrinks with the graph, from 100 up to 10k vertices
+# down to 10 for 100k and more, which keeps a 50k vertex layout to 20
+# iterations, around half a minute, instead of minutes. At theta=1.0 the
+# repulsion on a vertex is off by a median of 1-2% of its exact value, but
+# where the pushes from either side nearly cancel it can be off by half or
+# more; theta=0.5 brings that to a median of 0.2% and at most 10-20%, at
+# about three times the cost. A little seeded jitter each iteration moves
+# apart vertices that land on the same point, which push each other nowhere.
+FORCE_LAYOUT_WORK = 1_000_000
+
+
+def force_layout(graph, iterations=None, theta=1.0, size=(12, 7), seed=0):
+    n = len(graph.labels)
+    if n < 2:
+        return _fit_layout(graph, np.zeros((n, 2)), size)
+    if iterations is None:
+        iterations = min(100, max(10, FORCE_LAYOUT_WORK // n))
+    rng = np.random.default_rng(seed)
+    xy = rng.random((n, 2))
+    u, v = (np.asarray(ids, dtype=np.int64) for ids in graph.get_edge_ids())
+    k = sqrt(1 / n)
+    for i in range(iterations):
+        step = 0.1 * (1 - i / iterations)
+        force = _repulsion(xy, k, theta)
+        delta = xy[u] - xy[v]
+        pull = delta * (np.sqrt((delta * delta).sum(axis=1)) / k)[:, None]
+        for d in range(2):
+            force[:, d] -= np.bincount(u, pull[:, d], n)
+            force[:, d] += np.bincount(v, pull[:, d], n)
+        length = np.maximum(np.sqrt((force * force).sum(axis=1)), 1e-12)
+        xy += force * (np.minimum(length, step) / length)[:, None]
+        xy += rng.uniform(-1e-3, 1e-3, (n, 2)) * k * step
+    return _fit_layout(graph, xy, size)
+
+
+GRAPH_LAYOUTS = {
+    "bipartite": bipartite_layout,
+    "circular": circular_layout,
+    "force": force_layout,
+}
+
+
+PhaseEvent = namedtuple("PhaseEvent", ["phase", "layers"])
+AugmentEvent = namedtuple("AugmentEvent", ["phase", "path"])
+GrowEvent = namedtuple("GrowEvent", ["root", "edge", "matched_edge"])
+BlossomEvent = namedtuple("BlossomEvent", ["root", "base", "cycle"])
+ContractEvent = namedtuple("ContractEvent", ["root", "base", "vertices"])
+ExpandEvent = namedtuple("ExpandEvent", ["root", "base", "vertices"])
+
+
+def _adjacency(graph):
+    return {label: graph.neighbors(label) for label in graph.labels}
+
+
+def bipartition(graph):
+    adjacency = _adjacency(graph)
+    side = {}
+    for root in adjacency:
+        if root in side:
+            continue
+        side[root] = 0
+        queue = deque([root])
+        while queue:
+            u = queue.popleft()
+            for v in adjacency[u]:
+                if v not in side:
+                    side[v] = 1 - side[u]
+                    queue.append(v)
+                elif side[v] == side[u]:
+                    raise ValueError(
+                        f"Graph is not bipartite: {u}-{v} is on an odd cycle"
+                    )
+    left = [label for label in adjacency if side[label] == 0]
+    right = [label for label in adjacency if side[label] == 1]
+    return left, right
+
+
+def _initial_mates(graph):
+    if any(degree > 1 for degree in graph._matched_degree):
+        raise ValueError("graph.matching is not a matching")
+    return graph.mate.tolist()
+
+
+# Hopcroft-Karp on graph.edges, starting from graph.matching. Yields a
+# PhaseEvent per BFS layering, then an AugmentEvent per vertex-disjoint
+# shortest augmenting path of that phase. The graph itself is left alone;
+# scenes replay the events through invert_path/update_matching.
+def hopcroft_karp(graph, left=None):
+    if left is None:
+        left, _ = bipartition(graph)
+    labels = graph.labels
+    ids = graph.ids
+    n = len(labels)
+    is_left = [False] * n
+    for label in left:
+        is_left[ids[label]] = True
+
+    adj = [[] for _ in range(n)]
+    for u, v in zip(*graph.get_edge_ids()):
+        if is_left[u] == is_left[v]:
+            raise ValueError(
+                f"Edge {labels[u]}-{labels[v]} does not cross the bipartition"
+            )
+        if is_left[u]:
+            adj[u].append(v)
+        else:
+            adj[v].append(u)
+
+    mate = _initial_mates(graph)
+    left_ids = [i for i in range(n) if is_left[i]]
+    phase = 0
+    while True:
+        dist = [-1] * n
+        queue = [u for u in left_ids if mate[u] == -1]
+        for u in queue:
+            dist[u] = 0
+        limit = n
+        head = 0
+        while head < len(queue):
+            u = queue[head]
+            head += 1
+            if dist[u] >= limit:
+                break
+            for v in adj[u]:
+                w = mate[v]
+                if w == -1:
+                    limit = dist[u]
+                elif dist[w] == -1:
+                    dist[w] = dist[u] + 1
+                    queue.append(w)
+        if limit == n:
+            return
+
+        layers = [[] for _ in range(limit + 1)]
+        for u in queue:
+            if dist[u] <= limit:
+                layers[dist[u]].append(labels[u])
+        yield PhaseEvent(phase, layers)
+
+        it = [0] * n
+        for root in queue:
+            if dist[root] != 0:
+                break
+            stack = [root]
+            via = []
+            while stack:
+                u = stack[-1]
+                if it[u] == len(adj[u]):
+                    dist[u] = -1
+                    stack.pop()
+                    if via:
+                        via.pop()
+                    continue
+                v = adj[u][it[u]]
+                it[u] += 1
+                w = mate[v]
+                if w == -1:
+                    if dist[u] != limit:
+                        continue
+                    via.append(v)
+                    path = []
+                    for x, y in zip(stack, via):
+                        mate[x] = y
+                        mate[y] = x
+                        path.append(labels[x])
+                        path.append(labels[y])
+                    yield AugmentEvent(phase, path)
+                    break
+                if dist[w] == dist[u] + 1:
+                    stack.append(w)
+                    via.append(v)
+        phase += 1
+
+
+# Edmonds' blossom algorithm on graph.edges, starting from graph.matching.
+# Blossoms are contracted implicitly through the base array and expanded
+# again by following parent pointers when a path is augmented. Every free
+# vertex is searched once; a failed search leaves a Hungarian tree whose
+# vertices can never lie on an augmenting path, so they are dropped from
+# the graph for the remaining searches. With trace=False only augment
+# events are yielded, which is what large validation runs want.
+def edmonds(graph, greedy=True, trace=True):
+    labels = graph.labels
+    n = len(labels)
+    adj = [[] for _ in range(n)]
+    for u, v in zip(*graph.get_edge_ids()):
+        if u != v:
+            adj[u].append(v)
+            adj[v].append(u)
+    mate = _initial_mates(graph)
+
+    if greedy:
+        for u in range(n):
+            if mate[u] != -1:
+                continue
+            for v in adj[u]:
+                if mate[v] == -1:
+                    mate[u] = v
+                    mate[v] = u
+                    yield AugmentEvent(-1, [labels[u], labels[v]])
+                    break
+
+    parent = [-1] * n
+    base = list(range(n))
+    even = [False] * n
+    removed = [False] * n
+    in_blossom = [False] * n
+    stamp = [-1] * n
+
+    def lca(a, b, token):
+        while True:
+            a = base[a]
+            stamp[a] = token
+            if mate[a] == -1:
+                break
+            a = parent[mate[a]]
+        while True:
+            b = base[b]
+            if stamp[b] == token:
+                return b
+            b = parent[mate[b]]
+
+    def mark(v, b, child, marked, cycle):
+        while base[v] != b:
+            for x in (base[v], base[mate[v]]):
+                if not in_blossom[x]:
+                    in_blossom[x] = True
+                    marked.append(x)
+            cycle.append(v)
+            cycle.append(mate[v])
+            parent[v] = child
+            child = mate[v]
+            v = parent[mate[v]]
+
+    search = 0
+    token = 0
+    for root in range(n):
+        if mate[root] != -1 or removed[root]:
+            continue
+        touched = [root]
+        # Blossom membership as groups of vertices: a group is absorbed,
+        # list and all, into the group of the new base, so what a
+        # contraction adds is a slice of its base's list, recorded by its
+        # bounds, and first_group gives the group each vertex started in,
+        # for finding the blossoms that hold a vertex by walking up from it.
+        group_members = []
+        group_parent = []
+        group_absorbed = []
+        group_contractions = []
+        first_group = {}
+        current = {}
+        contractions = []
+
+        def new_group(x):
+            first_group[x] = len(group_members)
+            group_members.append([x])
+            group_parent.append(-1)
+            group_absorbed.append(-1)
+            group_contractions.append([])
+            return first_group[x]
+
+        even[root] = True
+        queue = deque([root])
+        found = -1
+        while queue and found == -1:
+            v = queue.popleft()
+            for to in adj[v]:
+                if removed[to] or base[v] == base[to] or mate[v] == to:
+                    continue
+                if to == root or (mate[to] != -1 and parent[mate[to]] != -1):
+                    token += 1
+                    b = lca(v, to, token)
+                    marked = []
+                    left_side = []
+                    right_side = []
+                    mark(v, b, to, marked, left_side)
+                    mark(to, b, v, marked, right_side)
+                    g = current.get(b)
+                    if g is None:
+                        g = current[b] = new_group(b)
+                    merged = group_members[g]
+                    start = len(merged)
+                    for x in marked:
+                        in_blossom[x] = False
+                        if x == b:
+                            continue
+                        h = current.pop(x, None)
+                        if h is None:
+                            h = new_group(x)
+                        group_parent[h] = g
+                        group_absorbed[h] = len(contractions)
+                        for i in group_members[h]:
+                            base[i] = b
+                            merged.append(i)
+                            if not even[i]:
+                                even[i] = True
+                                queue.append(i)
+                    if trace:
+                        group_contractions[g].append(len(contractions))
+                        contractions.append((b, merged, start, len(merged)))
+                        cycle = [b] + left_side[::-1] + right_side
+                        yield BlossomEvent(
+                            labels[root], labels[b], [labels[x] for x in cycle]
+                        )
+                        # just the vertices joining b's blossom
+                        yield ContractEvent(
+                            labels[root],
+                            labels[b],
+                            [labels[x] for x in merged[start:]],
+                        )
+                elif parent[to] == -1:
+                    parent[to] = v
+                    touched.append(to)
+                    if mate[to] == -1:
+                        found = to
+                        break
+                    w = mate[to]
+                    even[w] = True
+                    touched.append(w)
+                    queue.append(w)
+                    if trace:
+                        yield GrowEvent(
+                            labels[root],
+                            (labels[v], labels[to]),
+                            (labels[to], labels[w]),
+                        )
+
+        if found == -1:
+            for i in touched:
+                removed[i] = True
+        else:
+            path = []
+            v = found
+            while v != -1:
+                pv = parent[v]
+                ppv = mate[pv]
+                mate[v] = pv
+                mate[pv] = v
+                path.append(v)
+                path.append(pv)
+                v = ppv
+            if trace:
+                # a vertex is in the contractions of its group from when it
+                # joined, then in its parent's from when the group was
+                # absorbed, and so on up
+                hit = []
+                done = {}
+                for x in set(path):
+                    g = first_group.get(x, -1)
+                    since = -1
+                    while g != -1:
+                        ks = group_contractions[g]
+                        end = len(ks) if g not in done else bisect_left(ks, done[g])
+                        hit += ks[bisect_left(ks, since) : end]
+                        if g in done:
+                            done[g] = min(done[g], since)
+                            break
+                        done[g] = since
+                        since = group_absorbed[g]
+                        g = group_parent[g]
+                for k in sorted(hit, reverse=True):
+                    b, merged, start, end = contractions[k]
+                    yield ExpandEvent(
+                        labels[root], labels[b], [labels[x] for x in merged[start:end]]
+                    )
+            yield AugmentEvent(search, [labels[x] for x in path])
+        for i in touched:
+            parent[i] = -1
+            base[i] = i
+            even[i] = False
+        search += 1
+
+
+def play_matching_events(scene, graph, events, highlight=True):
+    home = {}
+    tree = []
+    root = None
+
+    # contract and expand events carry only the vertices joining or leaving
+    # a blossom at that step, so home collects what has been collapsed
+    def expand(vertices=None):
+        if vertices is None:
+            vertices = list(home)
+        moved = {v: home.pop(v) for v in vertices if v in home}
+        if moved:
+            scene.play(graph.rearrange(moved))
+            scene.pause()
+
+    def clear_tree():
+        if tree:
+            scene.play(AnimationGroup(*(FadeOut(hl) for hl in tree)))
+            tree.clear()
+
+    for event in events:
+        if isinstance(event, (GrowEvent, BlossomEvent, ContractEvent, ExpandEvent)):
+            if event.root != root:
+                expand()
+                clear_tree()
+                root = event.root
+
+        if isinstance(event, GrowEvent):
+            if highlight:
+                hl = graph.highlight_path(*event.edge, event.matched_edge[1])
+                scene.play(Create(hl))
+                tree.append(hl)
+        elif isinstance(event, BlossomEvent):
+            if highlight:
+                hl = graph.highlight_path(*event.cycle, event.cycle[0])
+                scene.play(Create(hl.set_stroke(color=BLUE)))
+                scene.pause()
+                scene.play(FadeOut(hl))
+        elif isinstance(event, ContractEvent):
+            center = graph.points[event.base].get_center()
+            collapse = {}
+            for v in event.vertices:
+                if v != event.base:
+                    home.setdefault(v, graph.points[v].get_center())
+                    collapse[v] = center + (home[v] - center) * 0.0001
+            scene.play(graph.rearrange(collapse))
+            scene.pause()
+        elif isinstance(event, ExpandEvent):
+            expand(event.vertices)
+        elif isinstance(event, AugmentEvent):
+            expand()
+            graph.invert_path(*event.path)
+            if highlight:
+                path_hl = graph.highlight_path(*event.path)
+                scene.play(Create(path_hl))
+                scene.play(AnimationGroup(*graph.update_matching(), FadeOut(path_hl)))
+            else:
+                scene.play(AnimationGroup(*graph.update_matching()))
+            clear_tree()
+            scene.pause()
+
+    expand()
+    clear_tree()
+
+
+# Dense Hungarian algorithm (shortest augmenting paths over potentials)
+# minimizing the total cost of assigning every row of `cost` to a distinct
+# column. Each Dijkstra step is one vectorized pass over the columns, so the
+# Python-level work is O(n^2) and the arithmetic O(n^3). Returns the column
+# of every row and potentials u, v with u[i] + v[j] <= cost[i, j], tight on
+# the assignment.
+def hungarian(cost):
+    cost = np.asarray(cost, dtype=float)
+    if cost.shape[0] > cost.shape[1]:
+        row_of_col, v, u = hungarian(cost.T)
+        col_of_row = np.full(cost.shape[0], -1)
+        col_of_row[row_of_col] = np.arange(cost.shape[1])
+        return col_of_row, u, v
+
+    n, m = cost.shape
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    u[1:] = cost.min(axis=1) if m else 0
+    if n == m and n:
+        v[1:] = (cost - u[1:, None]).min(axis=0)
+
+    # column 0 is a virtual free column that the row being added starts from
+    row_of = np.zeros(m + 1, dtype=int)
+    way = np.zeros(m + 1, dtype=int)
+    for i in range(1, n + 1):
+        row_of[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = row_of[j0]
+            free = ~used
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            better = free[1:] & (reduced < minv[1:])
+            minv[1:][better] = reduced[better]
+            way[1:][better] = j0
+            masked = np.where(free, minv, np.inf)
+            j1 = int(masked.argmin())
+            delta = masked[j1]
+            u[row_of[used]] += delta
+            v[used] -= delta
+            minv[free] -= delta
+            j0 = j1
+            if row_of[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            row_of[j0] = row_of[j1]
+            j0 = j1
+
+    col_of_row = np.full(n, -1)
+    assigned = row_of[1:] > 0
+    col_of_row[row_of[1:][assigned] - 1] = np.arange(m)[assigned]
+    return col_of_row, u[1:], v[1:]
+
+
+# Maximum weight matching by successive shortest augmenting paths on the
+# sparse residual graph, with Dijkstra kept non-negative by potentials.
+# adj[i] lists (j, weight) pairs; stops once no path improves the weight.
+# Returns the matched column of every row (or -1) and potentials yl, yr
+# with yl[i] + yr[j] >= weight, tight on matched edges.
+def sparse_weighted_matching(n_left, n_right, adj):
+    inf = float("inf")
+    mate_l = [-1] * n_left
+    mate_r = [-1] * n_right
+    mate_w = [0.0] * n_right
+    pl = [0.0] * n_left
+    pr = [0.0] * n_right
+    for i in range(n_left):
+        for j, w in adj[i]:
+            pr[j] = min(pr[j], -w)
+    pt = min(pr, default=0.0)
+
+    while True:
+        dl = [inf] * n_left
+        dr = [inf] * n_right
+        back = [-1] * n_right
+        back_w = [0.0] * n_right
+        heap = []
+        for i in range(n_left):
+            if mate_l[i] == -1:
+                dl[i] = -pl[i]
+                heap.append((dl[i], i))
+        heapq.heapify(heap)
+        dt = inf
+        sink = -1
+        while heap:
+            d, x = heapq.heappop(heap)
+            if d >= dt:
+                break
+            if x < n_left:
+                if d > dl[x]:
+                    continue
+                for j, w in adj[x]:
+                    if mate_l[x] == j:
+                        continue
+                    nd = d + pl[x] - pr[j] - w
+                    if nd < dr[j]:
+                        dr[j] = nd
+                        back[j] = x
+                        back_w[j] = w
+                        heapq.heappush(heap, (nd, n_left + j))
             else:
-                self.match(*edge)
+                j = x - n_left
+                if d > dr[j]:
+                    continue
+                i = mate_r[j]
+                if i == -1:
+                    if d + pr[j] - pt < dt:
+                        dt = d + pr[j] - pt
+                        sink = j
+                    continue
+                nd = d + pr[j] - pl[i] + mate_w[j]
+                if nd < dl[i]:
+                    dl[i] = nd
+                    heapq.heappush(heap, (nd, i))
+
+        if sink == -1 or dt + pt >= 0:
+            break
+        for i in range(n_left):
+            pl[i] += min(dl[i], dt)
+        for j in range(n_right):
+            pr[j] += min(dr[j], dt)
+        pt += dt
+
+        j = sink
+        while j != -1:
+            i = back[j]
+            next_j = mate_l[i]
+            mate_l[i] = j
+            mate_r[j] = i
+            mate_w[j] = back_w[j]
+            j = next_j
+
+    return mate_l, [p - pt for p in pl], [pt - p for p in pr]
+
+
+DENSE_MATCHING_CELLS = 5000 * 5000
+
+
+# Maximum weight matching of a bipartite Graph using the weights given to
+# add_edge (unweighted edges count 1). Returns the matched edges and a
+# potential per vertex with y[a] + y[b] >= weight(a, b) on every edge of
+# positive weight, tight on the matching. Uses the dense Hungarian
+# algorithm whenever the cost matrix fits in DENSE_MATCHING_CELLS, which
+# is faster than the sparse variant even on sparse graphs of that size.
+def weighted_matching(graph, left=None, dense=None):
+    if left is None:
+        left, right = bipartition(graph)
+    else:
+        left_set = set(left)
+        right = [label for label in graph.points if label not in left_set]
+    row = {label: i for (i, label) in enumerate(left)}
+    col = {label: j for (j, label) in enumerate(right)}
+    weighted = []
+    for edge in graph.edges:
+        p1, p2 = edge if edge[0] in row else edge[::-1]
+        weight = graph.weights.get(edge, 1)
+        if weight > 0:
+            weighted.append((row[p1], col[p2], weight))
+    if dense is None:
+        dense = len(left) * len(right) <= DENSE_MATCHING_CELLS
+
+    if dense:
+        cost = np.zeros((len(left), len(right)))
+        for i, j, weight in weighted:
+            cost[i, j] = -weight
+        col_of_row, u, v = hungarian(cost)
+        yl, yr = -u, -v
+        matched = [(i, j) for (i, j) in enumerate(col_of_row) if j != -1]
+        matched = [(i, j) for (i, j) in matched if cost[i, j] < 0]
+    else:
+        adj = [[] for _ in left]
+        for i, j, weight in weighted:
+            adj[i].append((j, weight))
+        col_of_row, yl, yr = sparse_weighted_matching(len(left), len(right), adj)
+        matched = [(i, j) for (i, j) in enumerate(col_of_row) if j != -1]
+
+    potentials = {label: float(yl[i]) for (label, i) in row.items()}
+    potentials.update({label: float(yr[j]) for (label, j) in col.items()})
+    pairs = [tuple(sorted((left[i], right[j]))) for (i, j) in matched]
+    return pairs, potentials
+
+
+def weighted_matching_tex(graph, *matchings):
+    lines = []
+    for edges in matchings:
+        weights = [graph.weights.get(tuple(sorted(edge)), 1) for edge in edges]
+        terms = " + ".join(f"{w:g}" for w in weights)
+        lines.append(f"{terms} &= {sum(weights):g}")
+    # every line but the last ends the row
+    return [line + r"\\" for line in lines[:-1]] + lines[-1:]
 
 
 def _make_even_cycle_graph():
@@ -332,20 +2740,84 @@ def make_matte(w, h):
     )
 
 
+ProposeEvent = namedtuple(
+    "ProposeEvent", ["proposer", "acceptor", "accepted", "rejected"]
+)
+
+
+def preference_ranks(prefs, size):
+    ranks = []
+    for pref in prefs:
+        rank = array("i", [size]) * size
+        for i, other in enumerate(pref):
+            rank[other] = i
+        ranks.append(rank)
+    return ranks
+
+
+# Proposer-optimal Gale-Shapley. Preferences are lists of indices into the
+# other side, most preferred first; anyone left off a list is unacceptable.
+# Returns the (proposer, acceptor) pairs sorted by proposer and the trace
+# of every proposal made.
+def gale_shapley(proposer_prefs, acceptor_prefs):
+    n = len(proposer_prefs)
+    rank = preference_ranks(acceptor_prefs, n)
+    next_choice = array("i", [0]) * n
+    partner = array("i", [-1]) * len(acceptor_prefs)
+    free = list(range(n - 1, -1, -1))
+    trace = []
+    while free:
+        p = free.pop()
+        if next_choice[p] == len(proposer_prefs[p]):
+            continue
+        a = proposer_prefs[p][next_choice[p]]
+        next_choice[p] += 1
+        current = partner[a]
+        if rank[a][p] == n:
+            free.append(p)
+            trace.append(ProposeEvent(p, a, False, p))
+        elif current == -1:
+            partner[a] = p
+            trace.append(ProposeEvent(p, a, True, None))
+        elif rank[a][p] < rank[a][current]:
+            partner[a] = p
+            free.append(current)
+            trace.append(ProposeEvent(p, a, True, current))
+        else:
+            free.append(p)
+            trace.append(ProposeEvent(p, a, False, p))
+    pairs = sorted((p, a) for (a, p) in enumerate(partner) if p != -1)
+    return pairs, trace
+
+
+def blocking_pairs(pairs, proposer_prefs, acceptor_prefs):
+    n = len(proposer_prefs)
+    rank = preference_ranks(acceptor_prefs, n)
+    proposer_partner = array("i", [-1]) * n
+    acceptor_partner = array("i", [-1]) * len(acceptor_prefs)
+    for p, a in pairs:
+        proposer_partner[p] = a
+        acceptor_partner[a] = p
+    blocking = []
+    for p, pref in enumerate(proposer_prefs):
+        for a in pref:
+            if a == proposer_partner[p]:
+                break
+            current = acceptor_partner[a]
+            if rank[a][p] < n and (current == -1 or rank[a][p] < rank[a][current]):
+                blocking.append((p, a))
+    return blocking
+
+
 class StableMatching(MyScene):
     def construct(self):
-        text = [
-            [
-                MathTex("A", font_size=64),
-                MathTex("B", font_size=64),
-                MathTex("C", font_size=64),
-            ],
-            [
-                MathTex(r"\alpha", font_size=64),
-                MathTex(r"\beta", font_size=64),
-                MathTex(r"\gamma", font_size=64),
-            ],
-        ]
+        names = [["A", "B", "C"], [r"\alpha", r"\beta", r"\gamma"]]
+        proposer_prefs = [[0, 1, 2], [1, 0, 2], [0, 2, 1]]
+        acceptor_prefs = [[1, 0, 2], [0, 1, 2], [2, 0, 1]]
+        proposer_rank = preference_ranks(proposer_prefs, len(acceptor_prefs))
+        acceptor_rank = preference_ranks(acceptor_prefs, len(proposer_prefs))
+
+        text = [[MathTex(name, font_size=64) for name in side] for side in names]
 
         grid = VGroup(*text[0], *text[1]).arrange_in_grid(
             cols=2, flow_order="dr", col_widths=[3] * 2, row_heights=[2] * 3
@@ -363,22 +2835,18 @@ class StableMatching(MyScene):
                 text[a[0]][a[1]].get_center(), text[b[0]][b[1]].get_center(), buff=0.5
             )
 
-        matching1 = [
-            edge((0, 0), (1, 1)),
-            edge((0, 1), (1, 2)),
-            edge((0, 2), (1, 0)),
-        ]
+        def arrows(pairs):
+            return [edge((0, p), (1, a)) for (p, a) in pairs]
+
+        pairs1 = [(0, 1), (1, 2), (2, 0)]
+        matching1 = arrows(pairs1)
 
         self.play(LaggedStart(*[GrowArrow(a) for a in matching1], lag_ratio=0.25))
         self.pause()
         self.play(LaggedStart(*[FadeOut(a) for a in matching1], lag_ratio=0.15))
         self.pause()
 
-        matching2 = [
-            edge((0, 0), (1, 0)),
-            edge((0, 1), (1, 1)),
-            edge((0, 2), (1, 2)),
-        ]
+        matching2 = arrows(gale_shapley(proposer_prefs, acceptor_prefs)[0])
 
         self.play(LaggedStart(*[GrowArrow(a) for a in matching2], lag_ratio=0.25))
         self.pause()
@@ -437,13 +2905,8 @@ class StableMatching(MyScene):
             for letter in column
         ]
 
-        prefs = [
-            [r"\alpha", r"\beta", r"\gamma"],
-            [r"\beta", r"\alpha", r"\gamma"],
-            [r"\alpha", r"\gamma", r"\beta"],
-            ["B", "A", "C"],
-            ["A", "B", "C"],
-            ["C", "A", "B"],
+        prefs = [[names[1][a] for a in pref] for pref in proposer_prefs] + [
+            [names[0][p] for p in pref] for pref in acceptor_prefs
         ]
 
         prefs_mtext = [
@@ -513,86 +2976,103 @@ class StableMatching(MyScene):
         self.play(LaggedStart(*[GrowArrow(a) for a in matching1], lag_ratio=0.25))
         self.pause()
 
+        # p and a prefer each other to the partners p_a and a_p given by matching1
+        (p, a), *_ = blocking_pairs(pairs1, proposer_prefs, acceptor_prefs)
+        a_p = dict(pairs1)[p]
+        p_a = dict((a, p) for (p, a) in pairs1)[a]
+
         self.play(
-            LaggedStart(Indicate(text[0][0]), Indicate(text[1][0]), lag_ratio=0.8)
+            LaggedStart(Indicate(text[0][p]), Indicate(text[1][a]), lag_ratio=0.8)
         )
         self.pause()
         self.play(
             AnimationGroup(
-                Indicate(prefs_mtext[0][1]),
-                Indicate(prefs_mtext[3][2]),
-                IndicateEdges(pref_squares[0][1], scale_factor=1.5),
-                IndicateEdges(pref_squares[3][2], scale_factor=1.5),
-                Indicate(matching1[0]),
-                Indicate(matching1[2]),
+                Indicate(prefs_mtext[p][proposer_rank[p][a_p]]),
+                Indicate(prefs_mtext[3 + a][acceptor_rank[a][p_a]]),
+                IndicateEdges(pref_squares[p][proposer_rank[p][a_p]], scale_factor=1.5),
+                IndicateEdges(
+                    pref_squares[3 + a][acceptor_rank[a][p_a]], scale_factor=1.5
+                ),
+                Indicate(matching1[p]),
+                Indicate(matching1[p_a]),
             )
         )
         self.pause()
         self.play(
             AnimationGroup(
-                Indicate(prefs_mtext[0][0]),
-                Indicate(prefs_mtext[3][1]),
-                IndicateEdges(pref_squares[0][0], scale_factor=1.5),
-                IndicateEdges(pref_squares[3][1], scale_factor=1.5),
+                Indicate(prefs_mtext[p][proposer_rank[p][a]]),
+                Indicate(prefs_mtext[3 + a][acceptor_rank[a][p]]),
+                IndicateEdges(pref_squares[p][proposer_rank[p][a]], scale_factor=1.5),
+                IndicateEdges(
+                    pref_squares[3 + a][acceptor_rank[a][p]], scale_factor=1.5
+                ),
             )
         )
         self.pause()
 
-        matching1[0].set_z_index(-1)
-        matching1[2].set_z_index(-1)
+        matching1[p].set_z_index(-1)
+        matching1[p_a].set_z_index(-1)
         self.play(
             AnimationGroup(
-                matching1[0].animate.set_stroke(color=GRAY_E).set_fill(color=GRAY_E),
-                matching1[2].animate.set_stroke(color=GRAY_E).set_fill(color=GRAY_E),
+                matching1[p].animate.set_stroke(color=GRAY_E).set_fill(color=GRAY_E),
+                matching1[p_a].animate.set_stroke(color=GRAY_E).set_fill(color=GRAY_E),
             )
         )
         self.pause()
 
         self.play(
             Circumscribe(
-                VGroup(text[0][0], text[1][0], *prefs_mtext[0], *prefs_mtext[3])
+                VGroup(text[0][p], text[1][a], *prefs_mtext[p], *prefs_mtext[3 + a])
             )
         )
         self.pause()
 
-        extra_edge = edge((0, 0), (1, 0))
+        extra_edge = edge((0, p), (1, a))
         self.play(GrowArrow(extra_edge))
         self.pause()
 
-        self.play(AnimationGroup(Indicate(text[0][2]), Indicate(text[1][1])))
+        self.play(AnimationGroup(Indicate(text[0][p_a]), Indicate(text[1][a_p])))
         self.pause()
 
         self.play(AnimationGroup(*[FadeOut(a) for a in matching1], FadeOut(extra_edge)))
         self.pause()
 
-        matching3 = [
-            edge((0, 0), (1, 1)),
-            edge((0, 1), (1, 0)),
-            edge((0, 2), (1, 2)),
-        ]
+        # the acceptor-optimal stable matching, found by letting acceptors propose
+        pairs3 = sorted(
+            (p, a) for (a, p) in gale_shapley(acceptor_prefs, proposer_prefs)[0]
+        )
+        matching3 = arrows(pairs3)
         self.play(LaggedStart(*[GrowArrow(a) for a in matching3], lag_ratio=0.25))
         self.pause()
 
+        # the first proposer would rather have their top choice, who in turn
+        # prefers the partner they already have
+        p = 0
+        a = proposer_prefs[p][0]
+        p_a = dict((a, p) for (p, a) in pairs3)[a]
+        a_p = dict(pairs3)[p]
         self.play(
             AnimationGroup(
-                Indicate(prefs_mtext[0][1]),
-                IndicateEdges(pref_squares[0][1], scale_factor=1.5),
-                Indicate(matching3[0]),
+                Indicate(prefs_mtext[p][proposer_rank[p][a_p]]),
+                IndicateEdges(pref_squares[p][proposer_rank[p][a_p]], scale_factor=1.5),
+                Indicate(matching3[p]),
             )
         )
         self.pause()
         self.play(
             AnimationGroup(
-                Indicate(prefs_mtext[0][0]),
-                IndicateEdges(pref_squares[0][0], scale_factor=1.5),
+                Indicate(prefs_mtext[p][proposer_rank[p][a]]),
+                IndicateEdges(pref_squares[p][proposer_rank[p][a]], scale_factor=1.5),
             )
         )
         self.pause()
         self.play(
             AnimationGroup(
-                Indicate(prefs_mtext[3][0]),
-                IndicateEdges(pref_squares[3][0], scale_factor=1.5),
-                Indicate(matching3[1]),
+                Indicate(prefs_mtext[3 + a][acceptor_rank[a][p_a]]),
+                IndicateEdges(
+                    pref_squares[3 + a][acceptor_rank[a][p_a]], scale_factor=1.5
+                ),
+                Indicate(matching3[p_a]),
             )
         )
         self.pause()
@@ -3290,71 +5770,75 @@ class WeightedMatching(MyScene):
         graph = Graph(graph_points)
         graph.get_group().move_to(ORIGIN)
 
-        graph.add_edge("A", "X")
-        graph.add_edge("A", "Y")
-        graph.add_edge("B", "X")
-        graph.add_edge("C", "Y")
+        graph.add_edge("A", "X", weight=55)
+        graph.add_edge("A", "Y", weight=89)
+        graph.add_edge("B", "X", weight=45)
+        graph.add_edge("C", "Y", weight=60)
 
-        weights = [
-            MathTex("55", font_size=42).move_to(
-                graph.points["X"].get_center() + 0.8 * UP + 1.5 * LEFT
-            ),
-            MathTex("45", font_size=42).move_to(
-                graph.points["B"].get_center() + 0.6 * UP + 0.5 * RIGHT
-            ),
-            MathTex("89", font_size=42).move_to(
-                graph.points["Y"].get_center() + 0.75 * UP + 0.3 * LEFT
-            ),
-            MathTex("60", font_size=42).move_to(
-                graph.points["C"].get_center() + 0.8 * UP + 1.2 * RIGHT
-            ),
-        ]
+        weight_offsets = {
+            ("A", "X"): ("X", 0.8 * UP + 1.5 * LEFT),
+            ("B", "X"): ("B", 0.6 * UP + 0.5 * RIGHT),
+            ("A", "Y"): ("Y", 0.75 * UP + 0.3 * LEFT),
+            ("C", "Y"): ("C", 0.8 * UP + 1.2 * RIGHT),
+        }
+        weights = {
+            edge: MathTex(f"{graph.weights[edge]:g}", font_size=42).move_to(
+                graph.points[p].get_center() + offset
+            )
+            for (edge, (p, offset)) in weight_offsets.items()
+        }
 
-        circs = [
-            get_bounding_rect(x, buff=0.1, stroke_color=YELLOW, stroke_width=5)
-            for x in weights
-        ]
+        circs = {
+            edge: get_bounding_rect(x, buff=0.1, stroke_color=YELLOW, stroke_width=5)
+            for (edge, x) in weights.items()
+        }
+
+        # terms are listed top to bottom, in the order of their right endpoint
+        greedy = [("A", "X"), ("C", "Y")]
+        best = sorted(weighted_matching(graph)[0], key=lambda edge: edge[1])
 
         equation = MathTex(
-            r"55 + 60 &= 115\\",
-            r"45 + 89 &= 134",
+            *weighted_matching_tex(graph, greedy, best),
         ).to_edge(RIGHT, buff=1)
 
         graph.draw_points(self)
         graph.draw_edges(self)
         self.pause()
-        self.play(LaggedStart(*[Write(x) for x in weights], lag_ratio=0.2))
+        self.play(LaggedStart(*[Write(x) for x in weights.values()], lag_ratio=0.2))
         self.pause()
 
-        graph.match("A", "X")
-        graph.match("C", "Y")
+        for edge in greedy:
+            graph.match(*edge)
         self.play(*graph.update_matching())
         self.pause()
 
         self.play(
             LaggedStart(
-                Create(circs[0]), Create(circs[3]), Write(equation[0]), lag_ratio=0.2
+                *[Create(circs[edge]) for edge in greedy],
+                Write(equation[0]),
+                lag_ratio=0.2,
             )
         )
         self.pause()
 
-        graph.unmatch("A", "X")
-        graph.unmatch("C", "Y")
+        for edge in greedy:
+            graph.unmatch(*edge)
         self.play(
             *graph.update_matching(),
-            FadeOut(circs[0]),
-            FadeOut(circs[3]),
+            *[FadeOut(circs[edge]) for edge in greedy],
         )
         self.pause()
 
-        graph.match("B", "X")
-        graph.match("A", "Y")
+        for edge in best:
+            graph.match(*edge)
         self.play(*graph.update_matching())
         self.pause()
 
         self.play(
             LaggedStart(
-                Create(circs[1]), Create(circs[2]), Write(equation[1]), lag_ratio=0.2
+                *[Create(circs[edge]) for edge in best],
+                Write(equation[1]),
+                lag_ratio=0.2,
             )
         )
         self.pause()
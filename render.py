@@ -0,0 +1,560 @@
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import traceback
+import types
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import manim
+from PIL import Image, ImageDraw
+
+import main
+
+CACHE_FILE = os.path.join("media", "render_cache.json")
+QUALITY_DIRS = {
+    "l": "480p15",
+    "m": "720p30",
+    "h": "1080p60",
+    "p": "1440p60",
+    "k": "2160p60",
+}
+QUALITY_NAMES = {
+    "l": "low_quality",
+    "m": "medium_quality",
+    "h": "high_quality",
+    "p": "production_quality",
+    "k": "fourk_quality",
+}
+
+
+def get_scenes():
+    return [
+        obj
+        for obj in vars(main).values()
+        if isinstance(obj, type)
+        and issubclass(obj, main.MyScene)
+        and obj is not main.MyScene
+    ]
+
+
+def _referenced_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _referenced_names(const)
+    return names
+
+
+def _functions(member):
+    if isinstance(member, (staticmethod, classmethod)):
+        member = member.__func__
+    if isinstance(member, property):
+        return [f for f in (member.fget, member.fset, member.fdel) if f is not None]
+    if isinstance(member, types.FunctionType):
+        return [member]
+    return []
+
+
+def _own_code(obj):
+    if isinstance(obj, types.FunctionType):
+        return [obj.__code__]
+    return [f.__code__ for member in vars(obj).values() for f in _functions(member)]
+
+
+def _is_main_code(value):
+    return getattr(value, "__module__", None) == "main" and isinstance(
+        value, (type, types.FunctionType)
+    )
+
+
+# Everything held in a constant, at any depth, for following the functions
+# and classes in tables like GRAPH_LAYOUTS.
+def _contents(value):
+    if isinstance(value, dict):
+        items = [*value.keys(), *value.values()]
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        items = value
+    else:
+        return [value]
+    return [x for item in items for x in _contents(item)]
+
+
+# A repr that is the same in every process: functions and classes by name,
+# since their source is hashed on its own, and sets in sorted order.
+def _stable_repr(value):
+    if isinstance(value, (type, types.FunctionType)):
+        return f"{value.__module__}.{value.__qualname__}"
+    if isinstance(value, dict):
+        items = (f"{_stable_repr(k)}: {_stable_repr(v)}" for (k, v) in value.items())
+        return "{" + ", ".join(items) + "}"
+    if isinstance(value, (set, frozenset)):
+        return "{" + ", ".join(sorted(map(_stable_repr, value))) + "}"
+    if isinstance(value, list):
+        return "[" + ", ".join(map(_stable_repr, value)) + "]"
+    if isinstance(value, tuple):
+        return "(" + ", ".join(map(_stable_repr, value)) + ")"
+    return repr(value)
+
+
+# Everything in main.py that a scene's construct() can reach: the scene
+# itself, MyScene, and every helper function, class and constant they name,
+# followed transitively, through methods, properties and the functions held
+# in constant tables.
+def get_dependencies(scene):
+    seen = {}
+    stack = [scene, main.MyScene]
+    while stack:
+        obj = stack.pop()
+        name = obj.__name__
+        if name in seen:
+            continue
+        seen[name] = obj
+        refs = set()
+        for code in _own_code(obj):
+            refs |= _referenced_names(code)
+        if isinstance(obj, type):
+            refs |= {base.__name__ for base in obj.__bases__}
+        for ref in refs:
+            value = vars(main).get(ref)
+            if ref in seen or value is None or ref.startswith("__"):
+                continue
+            if _is_main_code(value):
+                stack.append(value)
+            elif isinstance(
+                value, (int, float, str, tuple, list, dict, set, frozenset)
+            ):
+                seen[ref] = value
+                stack += [x for x in _contents(value) if _is_main_code(x)]
+    return seen
+
+
+def _source(obj):
+    try:
+        return inspect.getsource(obj)
+    except (OSError, TypeError):
+        # namedtuples and other generated classes have no source of their own
+        return repr(getattr(obj, "_fields", obj))
+
+
+def scene_hash(scene, render_args):
+    hasher = hashlib.sha256()
+    hasher.update(manim.__version__.encode())
+    hasher.update(json.dumps(render_args).encode())
+    for name, obj in sorted(get_dependencies(scene).items()):
+        hasher.update(name.encode())
+        if isinstance(obj, (type, types.FunctionType)):
+            hasher.update(_source(obj).encode())
+        else:
+            hasher.update(_stable_repr(obj).encode())
+    return hasher.hexdigest()
+
+
+def output_path(scene, quality):
+    return os.path.join(
+        "media", "videos", "main", QUALITY_DIRS[quality], scene.__name__ + ".mp4"
+    )
+
+
+def load_cache():
+    if not os.path.exists(CACHE_FILE):
+        return {}
+    with open(CACHE_FILE) as f:
+        return json.load(f)
+
+
+def save_cache(cache):
+    os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+    with open(CACHE_FILE, "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+
+
+# manim subprocesses iterate over sets of vertex labels, so pin the hash
+# seed: every process must build the same scene, and the partial movie
+# hashes must not change from one run to the next
+RENDER_ENV = dict(os.environ, PYTHONHASHSEED="0")
+SEGMENT_DIR = os.path.join("media", "segments")
+PROFILE_DIR = os.path.join("media", "profile")
+PREVIEW_DIR = os.path.join("media", "preview")
+
+Job = namedtuple("Job", ["scene", "part", "first", "last", "estimate"])
+
+
+def segment_media_dir(job):
+    return os.path.join(SEGMENT_DIR, job.scene.__name__, str(job.part))
+
+
+def segment_path(job, quality):
+    return os.path.join(
+        segment_media_dir(job), "videos", "main", QUALITY_DIRS[quality], "part.mp4"
+    )
+
+
+# Each segment is rendered by its own manim process, which replays
+# construct() with every animation before `first` skipped (so the mobject
+# state it starts from is the same one the full render would reach) and
+# stops after `last`. Segments get their own media directory so they do not
+# fight over partial movie lists, but share one TeX directory.
+def render_job(job, quality, extra_args):
+    command = ["manim", "render", f"-q{quality}", *extra_args]
+    if job.part is not None:
+        command += ["-n", f"{job.first},{job.last}", "-o", "part"]
+        command += ["--media_dir", segment_media_dir(job)]
+        command += ["--config_file", os.path.join(SEGMENT_DIR, "segment.cfg")]
+    start = time.monotonic()
+    subprocess.run(
+        command + ["main.py", job.scene.__name__],
+        check=True,
+        env=RENDER_ENV,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    return time.monotonic() - start
+
+
+# Runs construct() without rendering anything, to find how many animations
+# the scene plays and where its pause() calls fall.
+def count_plays(name):
+    scene = getattr(main, name)(dry_run=True)
+    scene.render()
+    return scene.renderer.num_plays, scene.pause_indices
+
+
+# Dry-runs a scene for --check: its stats and how long construct() took,
+# or the traceback it failed with.
+def check_scene(name):
+    start = time.monotonic()
+    try:
+        scene = getattr(main, name)(dry_run=True)
+        scene.render()
+    except Exception:
+        return name, None, traceback.format_exc()
+    return name, dict(scene.get_stats(), wall=time.monotonic() - start), None
+
+
+def check(scenes, jobs):
+    failed = False
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = pool.map(check_scene, [scene.__name__ for scene in scenes])
+        for name, stats, error in results:
+            if error is not None:
+                print(f"{name}: failed\n{error}")
+                failed = True
+                continue
+            print(
+                f"{name:32} {stats['plays']:4d} plays {stats['seconds']:7.1f}s video"
+                f" {stats['mobjects']:4d} mobjects ({stats['family']} in all)"
+                f"  built in {stats['wall']:.1f}s"
+            )
+    return not failed
+
+
+# Cuts a scene into at most `parts` runs of whole slides with roughly the
+# same number of animations each; returns (first, last) animation numbers.
+def split_at_pauses(num_plays, pause_indices, parts):
+    bounds = [0]
+    for i in pause_indices:
+        if bounds[-1] + num_plays / parts <= i < num_plays:
+            bounds.append(i)
+    bounds.append(num_plays)
+    return [(a, b - 1) for (a, b) in zip(bounds, bounds[1:]) if b > a]
+
+
+def make_jobs(scenes, cache, quality, parts, jobs):
+    def last_time(scene):
+        entry = cache.get(f"{scene.__name__}@{quality}", {})
+        return entry.get("seconds", float("inf"))
+
+    if parts <= 1:
+        return [Job(scene, None, None, None, last_time(scene)) for scene in scenes]
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        counts = pool.map(count_plays, [scene.__name__ for scene in scenes])
+    result = []
+    for scene, (num_plays, pause_indices) in zip(scenes, counts):
+        segments = split_at_pauses(num_plays, pause_indices, parts)
+        if len(segments) <= 1:
+            result.append(Job(scene, None, None, None, last_time(scene)))
+            continue
+        for part, (first, last) in enumerate(segments):
+            estimate = last_time(scene) * (last - first + 1) / max(1, num_plays)
+            result.append(Job(scene, part, first, last, estimate))
+    return result
+
+
+# Longest job first, using how long each scene took last time. Scenes that
+# were never timed go first, since they are the ones we know least about.
+def schedule(jobs):
+    return sorted(jobs, key=lambda job: job.estimate, reverse=True)
+
+
+def concat(files, output):
+    list_file = output + ".txt"
+    with open(list_file, "w") as f:
+        for file in files:
+            f.write(f"file '{os.path.abspath(file)}'\n")
+    command = ["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0"]
+    command += ["-i", list_file, "-c", "copy", output]
+    subprocess.run(command, check=True)
+    os.remove(list_file)
+
+
+# Adds up the per-scene reports main.py wrote under PROFILE_DIR and prints
+# the source lines whose play()/wait() calls took longest overall.
+def summarize_profiles(scenes, limit=20):
+    names = {scene.__name__ for scene in scenes}
+    by_line = {}
+    for file in sorted(os.listdir(PROFILE_DIR)):
+        if not file.endswith(".json"):
+            continue
+        with open(os.path.join(PROFILE_DIR, file)) as f:
+            report = json.load(f)
+        if report["scene"] not in names:
+            continue
+        for call in report["calls"]:
+            if not call["rendered"]:
+                continue
+            entry = by_line.setdefault(
+                call["line"], {"scene": report["scene"], "calls": 0, "total": 0.0}
+            )
+            entry["calls"] += 1
+            entry["total"] += call["total"]
+    ranking = sorted(by_line.items(), key=lambda x: -x[1]["total"])
+    with open(os.path.join(PROFILE_DIR, "summary.json"), "w") as f:
+        json.dump([dict(line=line, **entry) for (line, entry) in ranking], f, indent=1)
+    print("slowest calls:")
+    for line, entry in ranking[:limit]:
+        print(
+            f"  main.py:{line:<6} {entry['total']:8.2f}s"
+            f"  {entry['calls']:4d} call(s)  {entry['scene']}"
+        )
+
+
+def preview_frame_dir(scene_name):
+    return os.path.join(PREVIEW_DIR, scene_name)
+
+
+# Renders the sampled frames of one segment of a scene (see main.Preview);
+# run in a worker process, like count_plays.
+def preview_job(name, first, last, samples, quality):
+    manim.config.quality = QUALITY_NAMES[quality]
+    preview = main.Preview(samples, preview_frame_dir(name), first, last)
+    try:
+        getattr(main, name)(preview=preview).render()
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+# One row per slide (wrapping after `columns` frames), each frame labelled
+# with its play() number.
+def contact_sheet(frame_dir, output, width=320, columns=6, gap=8):
+    files = sorted(name for name in os.listdir(frame_dir) if name.endswith(".png"))
+    if not files:
+        return
+    rows = []
+    for name in files:
+        slide = name.split("-")[0]
+        if not rows or rows[-1][0] != slide or len(rows[-1][1]) == columns:
+            rows.append((slide, []))
+        rows[-1][1].append(name)
+    with Image.open(os.path.join(frame_dir, files[0])) as first:
+        height = round(width * first.height / first.width)
+    sheet = Image.new(
+        "RGB",
+        (gap + columns * (width + gap), gap + len(rows) * (height + gap)),
+        (64, 64, 64),
+    )
+    draw = ImageDraw.Draw(sheet)
+    for y, (slide, names) in enumerate(rows):
+        for x, name in enumerate(names):
+            with Image.open(os.path.join(frame_dir, name)) as frame:
+                thumbnail = frame.convert("RGB").resize((width, height))
+            corner = (gap + x * (width + gap), gap + y * (height + gap))
+            sheet.paste(thumbnail, corner)
+            play = int(name.split("-")[1])
+            draw.text((corner[0] + 4, corner[1] + 2), f"{int(slide)}/{play}")
+    sheet.save(output)
+
+
+# Frames sampled from every play() instead of a video, with the scenes cut
+# into segments as for --split and the segments rendered in parallel; each
+# scene ends up as a contact sheet in PREVIEW_DIR.
+def preview(scenes, cache, quality, samples, parts, jobs):
+    for scene in scenes:
+        shutil.rmtree(preview_frame_dir(scene.__name__), ignore_errors=True)
+    scene_jobs = schedule(make_jobs(scenes, cache, quality, parts, jobs))
+    failed = set()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(
+                preview_job,
+                job.scene.__name__,
+                job.first or 0,
+                job.last,
+                samples,
+                quality,
+            ): job
+            for job in scene_jobs
+        }
+        for future in as_completed(futures):
+            error = future.result()
+            if error is not None:
+                print(f"{futures[future].scene.__name__}: failed\n{error}")
+                failed.add(futures[future].scene)
+    for scene in scenes:
+        if scene in failed or not os.path.isdir(preview_frame_dir(scene.__name__)):
+            continue
+        output = os.path.join(PREVIEW_DIR, scene.__name__ + ".png")
+        contact_sheet(preview_frame_dir(scene.__name__), output)
+        print(f"{scene.__name__}: {output}")
+    return not failed
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(
+        description="Render the scenes in main.py, skipping unchanged ones."
+    )
+    parser.add_argument("scenes", nargs="*", help="scene names (default: all)")
+    parser.add_argument("-q", "--quality", default="h", choices=QUALITY_DIRS)
+    parser.add_argument("--force", action="store_true", help="ignore the cache")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="manim processes run at once (default: one per core)",
+    )
+    parser.add_argument(
+        "--split",
+        metavar="PARTS",
+        type=int,
+        default=1,
+        help="render each scene as up to PARTS segments cut at pause() calls",
+    )
+    parser.add_argument(
+        "--stitch", metavar="FILE", help="concatenate the scenes, in order, to FILE"
+    )
+    parser.add_argument(
+        "--preview",
+        metavar="SAMPLES",
+        type=int,
+        default=0,
+        help="save SAMPLES frames of every animation instead of a video, "
+        f"as contact sheets in {PREVIEW_DIR}",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="only build each scene, without rendering, and report on it",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=f"time every play() and write reports to {PROFILE_DIR}",
+    )
+    args, extra_args = parser.parse_known_args(argv)
+    jobs = max(1, args.jobs)
+
+    scenes = get_scenes()
+    if args.scenes:
+        by_name = {scene.__name__: scene for scene in scenes}
+        scenes = [by_name[name] for name in args.scenes]
+
+    if args.check:
+        sys.exit(0 if check(scenes, jobs) else 1)
+    if args.preview > 0:
+        ok = preview(scenes, load_cache(), args.quality, args.preview, args.split, jobs)
+        sys.exit(0 if ok else 1)
+    if args.profile:
+        RENDER_ENV["PROFILE_DIR"] = os.path.abspath(PROFILE_DIR)
+
+    cache = load_cache()
+    render_args = {"quality": args.quality, "extra": extra_args}
+    stale = []
+    digests = {}
+    for scene in scenes:
+        key = f"{scene.__name__}@{args.quality}"
+        digest = scene_hash(scene, render_args)
+        output = output_path(scene, args.quality)
+        entry = cache.get(key)
+        if (
+            not args.force
+            and entry is not None
+            and entry["hash"] == digest
+            and os.path.exists(output)
+        ):
+            print(f"{scene.__name__}: unchanged, reusing {output}")
+            continue
+        stale.append(scene)
+        digests[scene] = digest
+
+    if args.split > 1:
+        os.makedirs(SEGMENT_DIR, exist_ok=True)
+        with open(os.path.join(SEGMENT_DIR, "segment.cfg"), "w") as f:
+            tex_dir = os.path.abspath(os.path.join("media", "Tex"))
+            f.write(f"[CLI]\ntex_dir = {tex_dir}\n")
+
+    if args.profile and os.path.isdir(PROFILE_DIR):
+        # reports left from an earlier run, possibly split differently
+        for file in os.listdir(PROFILE_DIR):
+            scene_name = os.path.splitext(file)[0].split("-")[0]
+            if scene_name in {scene.__name__ for scene in stale}:
+                os.remove(os.path.join(PROFILE_DIR, file))
+
+    scene_jobs = make_jobs(stale, cache, args.quality, args.split, jobs)
+    remaining = {}
+    seconds = {}
+    for job in scene_jobs:
+        remaining.setdefault(job.scene, []).append(job)
+        seconds[job.scene] = 0
+
+    failed = set()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(render_job, job, args.quality, extra_args): job
+            for job in schedule(scene_jobs)
+        }
+        for future in as_completed(futures):
+            job = futures[future]
+            scene = job.scene
+            try:
+                seconds[scene] += future.result()
+            except subprocess.CalledProcessError as e:
+                print(f"{scene.__name__}: failed\n{e.stderr.decode()}")
+                failed.add(scene)
+                continue
+            remaining[scene].remove(job)
+            if remaining[scene] or scene in failed:
+                continue
+            if job.part is not None:
+                parts = sorted(
+                    (j for j in scene_jobs if j.scene is scene), key=lambda j: j.part
+                )
+                output = output_path(scene, args.quality)
+                os.makedirs(os.path.dirname(output), exist_ok=True)
+                concat([segment_path(j, args.quality) for j in parts], output)
+            print(f"{scene.__name__}: rendered in {seconds[scene]:.1f}s")
+            cache[f"{scene.__name__}@{args.quality}"] = {
+                "hash": digests[scene],
+                "output": output_path(scene, args.quality),
+                "seconds": seconds[scene],
+            }
+            save_cache(cache)
+
+    if args.profile and os.path.isdir(PROFILE_DIR):
+        summarize_profiles(stale)
+    if failed:
+        sys.exit(1)
+    if args.stitch:
+        concat([output_path(scene, args.quality) for scene in scenes], args.stitch)
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])